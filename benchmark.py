@@ -0,0 +1,100 @@
+"""
+Import time and startup benchmark.
+
+Every measurement runs in a fresh interpreter so module caches don't hide the
+cost of imports. Results are appended as one JSON line per run to the file
+given as the first argument (defaults to benchmark.jsonl), to be compared over
+time.
+
+With a cassette of a no-op run as the second argument, a whole run of main()
+is timed as well, replaying the cassette offline.
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from datetime import datetime, timezone
+
+REPEAT = 5
+
+# Imports each stage pulls in, the fast path stops after "budgets"
+STAGES = {
+    "main": "import main",
+    "budgets": "import dropbox, gspread, dbx, gsheet",
+    "fast_path": "import main, dropbox, gspread, dbx, gsheet, stocks",
+    "market_data": "import stocks, mnb, ksh, portfolio, pandas, yfinance, lxml.etree",
+}
+
+
+def measure(statement, env=None):
+    script = (
+        "import time\n"
+        "start = time.perf_counter()\n"
+        "{}\n"
+        "print(time.perf_counter() - start)\n"
+    ).format(statement)
+    timings = []
+    for _ in range(REPEAT):
+        result = subprocess.run(
+            [sys.executable, "-c", script],
+            capture_output=True,
+            text=True,
+            check=True,
+            env=env,
+        )
+        timings.append(float(result.stdout.strip()))
+    return round(statistics.median(timings), 4)
+
+
+def top_level_imports(statement, count=10):
+    """Slowest top level packages by cumulative import time, in seconds."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    packages = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        # Top level packages are not indented
+        if name.startswith("  ") or not cumulative.strip().isdigit():
+            continue
+        packages[name.strip()] = int(cumulative) / 1e6
+    slowest = sorted(packages.items(), key=lambda item: item[1], reverse=True)
+    return {name: round(seconds, 4) for name, seconds in slowest[:count]}
+
+
+def git_revision():
+    result = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+    )
+    return result.stdout.strip() or None
+
+
+if __name__ == "__main__":
+    filename = sys.argv[1] if len(sys.argv) > 1 else "benchmark.jsonl"
+    cassette = sys.argv[2] if len(sys.argv) > 2 else None
+
+    record = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "stages": {name: measure(statement) for name, statement in STAGES.items()},
+        "imports": top_level_imports(STAGES["fast_path"]),
+    }
+    if cassette is not None:
+        # Credential files are still read, the rest is served by the cassette
+        env = dict(os.environ, CASSETTE_MODE="replay", CASSETTE_FILENAME=cassette)
+        record["stages"]["no_op_run"] = measure("import main\nmain.main()", env)
+
+    for name, seconds in record["stages"].items():
+        print("{:<12} {:.4f}s".format(name, seconds))
+
+    with open(filename, "a") as fp:
+        fp.write(json.dumps(record) + "\n")
@@ -0,0 +1,155 @@
+import atexit
+import copy
+import gzip
+import logging
+import os
+import pickle
+import threading
+
+from urllib.parse import urlsplit
+
+RECORD = "record"
+REPLAY = "replay"
+
+
+class CassetteError(Exception):
+    pass
+
+
+class Cassette(object):
+    """
+    Record every external response of a run and replay them offline.
+
+    HTTP traffic is captured at requests.Session.request, which is what the
+    Dropbox SDK, gspread and the KSH, MNB and portfolio sources use. yfinance
+    doesn't use requests, so yf.download and yf.Ticker().info are captured at
+    the function level instead.
+
+    Responses are matched by method and URL without the query string, or by
+    the yfinance call and its tickers, and replayed in the order they were
+    recorded. Query strings are ignored as they contain the current date.
+    """
+
+    def __init__(self, filename: str, mode: str):
+        if mode not in (RECORD, REPLAY):
+            raise CassetteError("Unknown cassette mode: {}".format(mode))
+        self.filename = filename
+        self.mode = mode
+        self.interactions = {}
+        self._positions = {}
+        self._lock = threading.Lock()
+
+        if mode == REPLAY:
+            with gzip.open(filename, "rb") as fp:
+                self.interactions = pickle.load(fp)
+            logging.info(
+                "Replaying {} interactions from '{}'".format(
+                    sum(len(responses) for responses in self.interactions.values()),
+                    filename,
+                )
+            )
+
+    def call(self, key: tuple, func):
+        """Return the recorded result for key or record the result of func."""
+        if self.mode == RECORD:
+            result = func()
+            with self._lock:
+                self.interactions.setdefault(key, []).append(copy.deepcopy(result))
+            return result
+
+        with self._lock:
+            responses = self.interactions.get(key)
+            if not responses:
+                raise CassetteError("No recorded response for {}".format(key))
+            position = self._positions.get(key, 0)
+            # Calls beyond the recording, e.g. a token refresh, get the last response
+            self._positions[key] = position + 1
+            return copy.deepcopy(responses[min(position, len(responses) - 1)])
+
+    def save(self):
+        if self.mode != RECORD:
+            return
+        with self._lock:
+            tmp_filename = "{}.tmp".format(self.filename)
+            with gzip.open(tmp_filename, "wb") as fp:
+                pickle.dump(self.interactions, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_filename, self.filename)
+        logging.info("Cassette saved to '{}'".format(self.filename))
+
+    def install(self):
+        self._install_requests()
+        self._install_yfinance()
+        atexit.register(self.save)
+        logging.info("Cassette installed in {} mode".format(self.mode))
+
+    def _install_requests(self):
+        import requests
+
+        cassette = self
+        original_request = requests.Session.request
+
+        def request(session, method, url, *args, **kwargs):
+            parts = urlsplit(url)
+            key = (
+                "http",
+                method.upper(),
+                "{}://{}{}".format(parts.scheme, parts.netloc, parts.path),
+            )
+
+            def send():
+                response = original_request(session, method, url, *args, **kwargs)
+                return {
+                    "status_code": response.status_code,
+                    "reason": response.reason,
+                    "headers": dict(response.headers),
+                    "content": response.content,
+                    "encoding": response.encoding,
+                    "url": response.url,
+                }
+
+            recorded = cassette.call(key, send)
+            response = requests.Response()
+            response.status_code = recorded["status_code"]
+            response.reason = recorded["reason"]
+            response.headers = requests.structures.CaseInsensitiveDict(
+                recorded["headers"]
+            )
+            response._content = recorded["content"]
+            response._content_consumed = True
+            response.encoding = recorded["encoding"]
+            response.url = recorded["url"]
+            return response
+
+        requests.Session.request = request
+
+    def _install_yfinance(self):
+        import yfinance
+
+        cassette = self
+        original_download = yfinance.download
+        original_ticker = yfinance.Ticker
+
+        def download(tickers, *args, **kwargs):
+            names = tickers.split() if isinstance(tickers, str) else tickers
+            key = ("yfinance.download", tuple(sorted(names)))
+            return cassette.call(
+                key, lambda: original_download(tickers, *args, **kwargs)
+            )
+
+        class Ticker(object):
+            def __init__(self, ticker, *args, **kwargs):
+                self.ticker = ticker
+                self._args = args
+                self._kwargs = kwargs
+
+            @property
+            def info(self):
+                return cassette.call(
+                    ("yfinance.Ticker.info", self.ticker),
+                    lambda: original_ticker(
+                        self.ticker, *self._args, **self._kwargs
+                    ).info,
+                )
+
+        yfinance.download = download
+        yfinance.Ticker = Ticker
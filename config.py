@@ -7,6 +7,8 @@ def init_config():
         separator="__",
         whitelist=[
             "BUDGET",
+            "CASSETTE_FILENAME",
+            "CASSETTE_MODE",
             "DROPBOX_APP_KEY",
             "DROPBOX_APP_SECRET",
             "DROPBOX_OAUTH_TOKEN_FILENAME",
@@ -14,18 +16,38 @@ def init_config():
             "GSPREAD_CREDENTIALS_FILENAME",
             "GSPREAD_SHEET_NAME",
             "LOG_LEVEL",
+            "MATERIALIZE_DERIVED_COLUMNS",
+            "OUTPUT_SINKS",
+            "PROFILE_DIRECTORY",
+            "STATE_DIRECTORY",
+            "TRANSACTION_SHARDING",
+            "YFINANCE_ARCHIVE_FREQUENCY",
+            "YFINANCE_DAILY_WINDOW_DAYS",
         ],
     )
 
     Pconf.defaults(
         {
+            "CASSETTE_FILENAME": "cassette.pkl.gz",
+            "CASSETTE_MODE": "",
             "DROPBOX_OAUTH_TOKEN_FILENAME": "/run/secrets/token-dropbox.json",
             "GSPREAD_AUTHORIZED_USER_FILENAME": "/run/secrets/token.json",
             "GSPREAD_CREDENTIALS_FILENAME": "/run/secrets/credentials.json",
             "LOG_LEVEL": "INFO",
+            "MATERIALIZE_DERIVED_COLUMNS": "false",
+            "OUTPUT_SINKS": "",
+            "PROFILE_DIRECTORY": "",
+            "STATE_DIRECTORY": "/var/lib/ynab4-to-gsheet",
+            "TRANSACTION_SHARDING": "false",
+            "YFINANCE_ARCHIVE_FREQUENCY": "monthly",
+            "YFINANCE_DAILY_WINDOW_DAYS": "",
         }
     )
 
 
 def get_config():
     return Pconf.get()
+
+
+def is_enabled(value) -> bool:
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
@@ -1,10 +1,21 @@
+import gzip
 import json
 import logging
+import os
+import pickle
+import re
 
 from dropbox.exceptions import ApiError
 
 
-def find_latest_yfull(dbx, budget):
+def find_latest_yfull(dbx, budget, cache_directory=None):
+    """
+    Return the contents of the most recently modified yfull file of a budget.
+
+    With a cache directory the parsed contents are kept there along with the
+    file's revision, and loaded from there instead of downloading the file
+    again while the revision is unchanged.
+    """
     logging.info("Finding latest budget data for '{}'".format(budget))
     # Find data folder from ymeta
     _, content = dbx.files_download("/YNAB/{}/Budget.ymeta".format(budget))
@@ -13,13 +24,16 @@ def find_latest_yfull(dbx, budget):
     )
     logging.debug("Found data folder: '{}'".format(data_folder))
     mod_times = {}
+    revs = {}
 
     # Gather modification dates for yfull files
     for device in dbx.files_list_folder(data_folder).entries:
         try:
-            mod_times[device.name] = dbx.files_get_metadata(
+            metadata = dbx.files_get_metadata(
                 "{}/{}/Budget.yfull".format(data_folder, device.name)
-            ).server_modified
+            )
+            mod_times[device.name] = metadata.server_modified
+            revs[device.name] = metadata.rev
             logging.debug(
                 "Device '{}' last updated at '{}'".format(
                     device.name, mod_times[device.name]
@@ -31,5 +45,39 @@ def find_latest_yfull(dbx, budget):
     # Find the yfull file with the latest modification date and return its contents
     latest = sorted(mod_times.items(), key=lambda item: item[1])[-1][0]
     logging.info("Device with latest data: '{}'".format(latest))
-    _, content = dbx.files_download("{}/{}/Budget.yfull".format(data_folder, latest))
-    return json.loads(content.content)
+    path = "{}/{}/Budget.yfull".format(data_folder, latest)
+
+    cache_filename = None
+    if cache_directory is not None:
+        cache_filename = os.path.join(
+            cache_directory, "{}.pkl.gz".format(re.sub(r"[^\w.-]", "_", budget))
+        )
+        cached = load_cached_yfull(cache_filename)
+        if cached is not None and cached["rev"] == revs[latest]:
+            logging.info("Budget data is unchanged, loaded from '{}'".format(path))
+            return cached["data"]
+
+    _, content = dbx.files_download(path)
+    data = json.loads(content.content)
+    if cache_filename is not None:
+        save_cached_yfull(cache_filename, revs[latest], data)
+    return data
+
+
+def load_cached_yfull(filename):
+    try:
+        with gzip.open(filename, "rb") as fp:
+            return pickle.load(fp)
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, pickle.UnpicklingError) as e:
+        logging.warning("Failed to load cached budget '{}': {}".format(filename, e))
+        return None
+
+
+def save_cached_yfull(filename, rev, data):
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    tmp_filename = "{}.tmp".format(filename)
+    with gzip.open(tmp_filename, "wb", compresslevel=1) as fp:
+        pickle.dump({"rev": rev, "data": data}, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_filename, filename)
@@ -1,31 +1,131 @@
 import gspread
+import hashlib
+import json
 import logging
+import re
+import requests
+import time
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
+FINGERPRINT_KEY_PREFIX = "ynab4-to-gsheet/fingerprint/"
 
-def create_sheets(spreadsheet: gspread.Spreadsheet, extra_txn_curs: list[str]):
-    ynab_sheets = [
-        {"name": "Categories", "rows": 4, "cols": 1},
-        {"name": "Budgets", "rows": 2, "cols": 2},
-        {"name": "Transactions", "rows": 1, "cols": 7},
-    ]
-    for cur in extra_txn_curs:
-        ynab_sheets.append({"name": "Transactions{}".format(cur), "rows": 1, "cols": 7})
+# Sheets recommends keeping request payloads below 2 MB
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+UPLOAD_IN_FLIGHT = 3
+UPLOAD_ATTEMPTS = 4
+# Connect and read timeouts of Sheets requests, so a hung chunk is retried
+REQUEST_TIMEOUT = (10, 120)
+
+
+class UploadError(Exception):
+    pass
+
+
+class SheetRegistry(object):
+    """
+    Worksheet handles and developer metadata of a spreadsheet.
+
+    Everything is fetched with a single metadata request up front, missing
+    sheets are created with a single batch request, and the same Worksheet
+    handles are handed out to every stage afterwards.
+    """
 
-    logging.debug("Sheets to create: {}".format(ynab_sheets))
-    for sheet in ynab_sheets:
+    def __init__(self, spreadsheet: gspread.Spreadsheet):
+        self.spreadsheet = spreadsheet
+        metadata = spreadsheet.fetch_sheet_metadata(
+            params={
+                "fields": "sheets(properties),"
+                "developerMetadata(metadataKey,metadataValue)"
+            }
+        )
+        self.developer_metadata = metadata.get("developerMetadata", [])
+        self._worksheets = {}
+        for sheet in metadata.get("sheets", []):
+            self._add(sheet["properties"])
+        logging.debug("Worksheets: {}".format(list(self._worksheets.keys())))
+
+    def _add(self, properties: dict):
+        self._worksheets[properties["title"]] = gspread.worksheet.Worksheet(
+            self.spreadsheet, properties
+        )
+
+    def worksheet(self, title: str) -> gspread.worksheet.Worksheet:
         try:
-            # Try to get the worksheet; if it doesn't exist, create it
-            spreadsheet.worksheet("YNAB/{}".format(sheet["name"]))
-            logging.info("'{}' exists already ".format("YNAB/{}".format(sheet["name"])))
-        except gspread.exceptions.WorksheetNotFound:
-            logging.info("Creating '{}'".format("YNAB/{}".format(sheet["name"])))
-            spreadsheet.add_worksheet(
-                title="YNAB/{}".format(sheet["name"]),
-                rows=sheet["rows"],
-                cols=sheet["cols"],
+            return self._worksheets[title]
+        except KeyError:
+            raise gspread.exceptions.WorksheetNotFound(title)
+
+    def create_missing(self, sheets: list[dict]):
+        """Create the sheets (name, rows, cols) that don't exist yet."""
+        requests = []
+        for sheet in sheets:
+            if sheet["name"] in self._worksheets:
+                logging.info("'{}' exists already ".format(sheet["name"]))
+                continue
+            logging.info("Creating '{}'".format(sheet["name"]))
+            requests.append(
+                {
+                    "addSheet": {
+                        "properties": {
+                            "title": sheet["name"],
+                            "gridProperties": {
+                                "rowCount": sheet["rows"],
+                                "columnCount": sheet["cols"],
+                            },
+                        }
+                    }
+                }
             )
+        if not requests:
+            return
+
+        response = self.spreadsheet.batch_update({"requests": requests})
+        for reply in response["replies"]:
+            self._add(reply["addSheet"]["properties"])
+
+    def titles(self, prefix: str = "") -> list[str]:
+        return [title for title in self._worksheets if title.startswith(prefix)]
+
+    def delete(self, titles: list[str]):
+        """Delete the sheets with a single batch request."""
+        if not titles:
+            return
+        logging.info("Deleting {}".format(titles))
+        self.spreadsheet.batch_update(
+            {
+                "requests": [
+                    {"deleteSheet": {"sheetId": self._worksheets[title].id}}
+                    for title in titles
+                ]
+            }
+        )
+        for title in titles:
+            del self._worksheets[title]
+
+
+def create_sheets(
+    registry: SheetRegistry,
+    extra_txn_curs: list[str],
+    archive_prices: bool = False,
+):
+    sheets = [
+        {"name": "YNAB/Categories", "rows": 4, "cols": 1},
+        {"name": "YNAB/Budgets", "rows": 2, "cols": 2},
+        {"name": "YNAB/Transactions", "rows": 1, "cols": 7},
+        {"name": "YNAB/Activity", "rows": 1, "cols": 6},
+    ]
+    for cur in extra_txn_curs:
+        sheets.append(
+            {"name": "YNAB/Transactions{}".format(cur), "rows": 1, "cols": 7}
+        )
+    sheets.append({"name": "Valuation", "rows": 1, "cols": 2})
+    if archive_prices:
+        sheets.append({"name": "yfinance/archive", "rows": 1, "cols": 1})
+
+    logging.debug("Sheets to create: {}".format(sheets))
+    registry.create_missing(sheets)
 
 
 def is_knowledge_up_to_date(data, worksheet: gspread.worksheet.Worksheet) -> bool:
@@ -42,8 +142,227 @@ def update_saved_knowledge(data, worksheet: gspread.worksheet.Worksheet):
     logging.info("Updated knowledge in sheet to: {}".format(yfull_knowledge))
 
 
-def store_categories(data, worksheet: gspread.worksheet.Worksheet):
-    logging.info("Storing categories")
+def fingerprint(section) -> str:
+    """Stable content hash of a JSON-serializable part of the yfull data."""
+    payload = json.dumps(section, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def build_tables(data, currency: str = "", derived: dict = None) -> dict[str, list]:
+    """
+    Build the rows of every YNAB sheet filled from a budget.
+
+    The main budget (empty currency) fills Categories, Budgets and Transactions,
+    extra currency budgets only fill their own Transactions sheet.
+    """
+    tables = {"YNAB/Transactions{}".format(currency): build_transactions(data, derived)}
+    if currency == "":
+        tables["YNAB/Categories"] = build_categories(data)
+        tables["YNAB/Budgets"] = build_budgets(data)
+    return tables
+
+
+def table_fingerprints(
+    tables: dict[str, list], sharded: bool = False
+) -> dict[str, str]:
+    """
+    Fingerprint the rows built for each sheet, so edits of budget fields that
+    are not written to the sheets, like memos, don't cause rewrites.
+
+    Switching sharding on or off changes the Transactions fingerprint, so the
+    sheet is rebuilt in the new layout.
+    """
+    fingerprints = {}
+    for sheet, rows in tables.items():
+        if sharded and sheet.startswith("YNAB/Transactions"):
+            fingerprints[sheet] = fingerprint([rows, "sharded"])
+        else:
+            fingerprints[sheet] = fingerprint(rows)
+    return fingerprints
+
+
+def get_saved_fingerprints(registry: SheetRegistry) -> dict[str, str]:
+    """Read all stored table fingerprints from the fetched metadata."""
+    fingerprints = {}
+    for entry in registry.developer_metadata:
+        key = entry.get("metadataKey", "")
+        if key.startswith(FINGERPRINT_KEY_PREFIX):
+            fingerprints[key[len(FINGERPRINT_KEY_PREFIX) :]] = entry.get(
+                "metadataValue"
+            )
+    logging.debug("Saved fingerprints: {}".format(fingerprints))
+    return fingerprints
+
+
+def changed_tables(
+    fingerprints: dict[str, str], saved_fingerprints: dict[str, str]
+) -> dict[str, str]:
+    changed = {
+        sheet: value
+        for sheet, value in fingerprints.items()
+        if saved_fingerprints.get(sheet) != value
+    }
+    logging.info("Changed tables: {}".format(list(changed.keys())))
+    return changed
+
+
+def update_saved_fingerprints(
+    spreadsheet: gspread.Spreadsheet,
+    saved_fingerprints: dict[str, str],
+    fingerprints: dict[str, str],
+):
+    if not fingerprints:
+        return
+
+    requests = []
+    for sheet, value in fingerprints.items():
+        key = FINGERPRINT_KEY_PREFIX + sheet
+        if sheet in saved_fingerprints:
+            requests.append(
+                {
+                    "deleteDeveloperMetadata": {
+                        "dataFilter": {
+                            "developerMetadataLookup": {"metadataKey": key}
+                        }
+                    }
+                }
+            )
+        requests.append(
+            {
+                "createDeveloperMetadata": {
+                    "developerMetadata": {
+                        "metadataKey": key,
+                        "metadataValue": value,
+                        "location": {"spreadsheet": True},
+                        "visibility": "DOCUMENT",
+                    }
+                }
+            }
+        )
+
+    spreadsheet.batch_update({"requests": requests})
+    saved_fingerprints |= fingerprints
+    logging.info("Updated fingerprints for: {}".format(list(fingerprints.keys())))
+
+
+def delete_saved_fingerprints(
+    spreadsheet: gspread.Spreadsheet,
+    saved_fingerprints: dict[str, str],
+    sheets: list[str],
+):
+    sheets = [sheet for sheet in sheets if sheet in saved_fingerprints]
+    if not sheets:
+        return
+
+    spreadsheet.batch_update(
+        {
+            "requests": [
+                {
+                    "deleteDeveloperMetadata": {
+                        "dataFilter": {
+                            "developerMetadataLookup": {
+                                "metadataKey": FINGERPRINT_KEY_PREFIX + sheet
+                            }
+                        }
+                    }
+                }
+                for sheet in sheets
+            ]
+        }
+    )
+    for sheet in sheets:
+        del saved_fingerprints[sheet]
+    logging.info("Deleted fingerprints for: {}".format(sheets))
+
+
+def chunk_rows(rows: list[list], max_bytes: int) -> list[tuple[int, int]]:
+    """Split rows into (start, end) ranges, end exclusive, of at most max_bytes."""
+    chunks = []
+    start = 0
+    size = 0
+    for i, row in enumerate(rows):
+        row_size = len(json.dumps(row))
+        if i > start and size + row_size > max_bytes:
+            chunks.append((start, i))
+            start = i
+            size = 0
+        size += row_size
+    if rows:
+        chunks.append((start, len(rows)))
+    return chunks
+
+
+def upload_rows(
+    worksheet: gspread.worksheet.Worksheet, rows: list[list], batch=None
+):
+    """
+    Write rows from A1 in chunks, several of them in flight at once.
+
+    Rows are padded to the same width so every cell of the range is written
+    and the sheet doesn't have to be cleared first, a failed upload leaves the
+    previous data in place instead of an empty sheet. Each chunk's response is
+    checked and only failed chunks are retried, with exponential backoff.
+    Connection errors and timeouts fail a chunk like API errors do. Written
+    chunks are committed to the journal's batch if given, chunks it already
+    holds are skipped.
+    """
+    width = max(len(row) for row in rows)
+    rows = [row + [""] * (width - len(row)) for row in rows]
+    pending = chunk_rows(rows, UPLOAD_CHUNK_BYTES)
+    if batch is not None:
+        pending = [chunk for chunk in pending if chunk not in batch.committed]
+    logging.info("Uploading {} rows in {} chunks".format(len(rows), len(pending)))
+
+    def send(start, end):
+        range_name = "{}:{}".format(
+            gspread.utils.rowcol_to_a1(start + 1, 1),
+            gspread.utils.rowcol_to_a1(end, width),
+        )
+        response = worksheet.update(range_name, rows[start:end], raw=False)
+        updated_range = response.get("updatedRange", "")
+        if not re.search(r"[A-Z]+{}$".format(end), updated_range):
+            raise UploadError(
+                "Expected {} to be updated, got '{}'".format(range_name, updated_range)
+            )
+
+    for attempt in range(UPLOAD_ATTEMPTS):
+        if attempt > 0:
+            time.sleep(2**attempt)
+            logging.info("Retrying {} failed chunks".format(len(pending)))
+        failed = []
+        with ThreadPoolExecutor(max_workers=UPLOAD_IN_FLIGHT) as executor:
+            futures = {
+                executor.submit(send, start, end): (start, end)
+                for start, end in pending
+            }
+            for future in as_completed(futures):
+                start, end = futures[future]
+                try:
+                    future.result()
+                except (
+                    gspread.exceptions.APIError,
+                    requests.exceptions.RequestException,
+                    UploadError,
+                ) as e:
+                    logging.warning(
+                        "Uploading rows {}-{} failed: {}".format(start + 1, end, e)
+                    )
+                    failed.append((start, end))
+                    continue
+                if batch is not None:
+                    batch.commit(start, end)
+        if not failed:
+            return
+        pending = sorted(failed)
+
+    raise UploadError(
+        "Failed to upload {} chunks after {} attempts".format(
+            len(pending), UPLOAD_ATTEMPTS
+        )
+    )
+
+
+def build_categories(data) -> list[list]:
     categories = [[], [], [], []]
     for master_category in data.get("masterCategories", []):
         # Empty master category, skip
@@ -75,7 +394,14 @@ def store_categories(data, worksheet: gspread.worksheet.Worksheet):
                 categories[1].append("")
             categories[2].append(subcategory.get("entityId"))
             categories[3].append(subcategory.get("name"))
+    return categories
+
 
+def store_categories(
+    categories: list[list], worksheet: gspread.worksheet.Worksheet, batch=None
+):
+    """Store categories, small enough to rewrite, so batch is not used."""
+    logging.info("Storing categories")
     worksheet.clear()
     worksheet.unmerge_cells("2:2")
     worksheet.resize(4, len(categories[0]))
@@ -105,8 +431,7 @@ def store_categories(data, worksheet: gspread.worksheet.Worksheet):
             end_col = -1
 
 
-def store_budgets(data, worksheet: gspread.worksheet.Worksheet):
-    logging.info("Storing budgets")
+def build_budgets(data) -> list[list]:
     budgets = [["", ""], ["", ""]]
 
     first_transaction_date = datetime.strptime(
@@ -157,17 +482,47 @@ def store_budgets(data, worksheet: gspread.worksheet.Worksheet):
                 budgets[row_to_insert].extend([0 for _ in range(spaces_needed)])
             budgets[row_to_insert].append(subcategory_budget.get("budgeted"))
     budgets[2][1] = "=ARRAYFORMULA(HLOOKUP(A3:A;'YNAB/Categories'!A$3:ZZ$4;2;false))"
+    return budgets
 
-    worksheet.clear()
+
+def store_budgets(
+    budgets: list[list], worksheet: gspread.worksheet.Worksheet, batch=None
+):
+    logging.info("Storing budgets")
     worksheet.resize(len(budgets), len(budgets[0]))
-    worksheet.update(budgets, raw=False)
+    upload_rows(worksheet, budgets, batch)
     worksheet.freeze(2, 2)
     worksheet.hide_rows(0, 1)
     worksheet.hide_columns(0, 1)
 
 
-def store_transactions(data, worksheet: gspread.worksheet.Worksheet):
-    logging.info("Storing transactions")
+def derived_columns(data) -> dict:
+    """
+    Lookup tables to compute the derived transaction columns from, built from
+    the main budget the same way the sheet formulas look them up.
+    """
+    categories = build_categories(data)
+    huf_values = {}
+    for row in build_transactions(data)[1:]:
+        check_number, amount = row[2], row[4]
+        # Transactions without a check number aren't linked to anything
+        if not check_number:
+            continue
+        huf_values[check_number] = huf_values.get(check_number, 0) + amount
+    return {
+        "masterCategories": dict(zip(categories[2], categories[0])),
+        "hufValues": huf_values,
+    }
+
+
+def build_transactions(data, derived: dict = None) -> list[list]:
+    """
+    Build the transaction rows.
+
+    The masterCategoryId, monthStart and hufValue columns are header
+    ARRAYFORMULAs by default. With the lookup tables from derived_columns
+    they are computed here and written as plain values instead.
+    """
     transactions = [
         [
             "accountId",
@@ -179,16 +534,22 @@ def store_transactions(data, worksheet: gspread.worksheet.Worksheet):
             "targetAccountId",
         ]
     ]
-    transactions[0].append(
-        """=ARRAYFORMULA({{"masterCategoryId";IF(ISBLANK(D2:D);"";XLOOKUP(D2:D;'YNAB/Categories'!$3:$3;'YNAB/Categories'!$1:$1;;0))}})"""
-    )
-    transactions[0].append(
-        """=ARRAYFORMULA({{"monthStart";IF(ISBLANK(B2:B);"";EOMONTH(B2:B;-1)+1)}})"""
-    )
-    if data.get("budgetMetaData").get("currencyLocale") != "hu_HU":
+    huf_value = data.get("budgetMetaData").get("currencyLocale") != "hu_HU"
+    if derived is not None:
+        transactions[0].extend(["masterCategoryId", "monthStart"])
+        if huf_value:
+            transactions[0].append("hufValue")
+    else:
         transactions[0].append(
-            """=ARRAYFORMULA({{"hufValue";ARRAYFORMULA(SUMIF('YNAB/Transactions'!C2:C;C2:C;'YNAB/Transactions'!E2:E))}})"""
+            """=ARRAYFORMULA({{"masterCategoryId";IF(ISBLANK(D2:D);"";XLOOKUP(D2:D;'YNAB/Categories'!$3:$3;'YNAB/Categories'!$1:$1;;0))}})"""
         )
+        transactions[0].append(
+            """=ARRAYFORMULA({{"monthStart";IF(ISBLANK(B2:B);"";EOMONTH(B2:B;-1)+1)}})"""
+        )
+        if huf_value:
+            transactions[0].append(
+                """=ARRAYFORMULA({{"hufValue";ARRAYFORMULA(SUMIF('YNAB/Transactions'!C2:C;C2:C;'YNAB/Transactions'!E2:E))}})"""
+            )
 
     for transaction in data.get("transactions"):
         t = {}
@@ -216,7 +577,190 @@ def store_transactions(data, worksheet: gspread.worksheet.Worksheet):
             t["targetAccountId"] = transaction.get("targetAccountId", "")
             transactions.append(list(t.values()))
 
+    if derived is not None:
+        # Hash joins on categoryId and checkNumber instead of sheet lookups
+        master_categories = derived["masterCategories"]
+        huf_values = derived["hufValues"]
+        for row in transactions[1:]:
+            row.append(master_categories.get(row[3], "") if row[3] else "")
+            row.append(row[1][:8] + "01")
+            if huf_value:
+                row.append(huf_values.get(row[2], 0) if row[2] else "")
+    return transactions
+
+
+def changed_row_ranges(previous: list[list], rows: list[list]) -> list[tuple[int, int]]:
+    """Return (start, end) index ranges, end exclusive, of rows that differ."""
+    ranges = []
+    start = None
+    for i, row in enumerate(rows):
+        changed = i >= len(previous) or previous[i] != row
+        if changed and start is None:
+            start = i
+        elif not changed and start is not None:
+            ranges.append((start, i))
+            start = None
+    if start is not None:
+        ranges.append((start, len(rows)))
+    return ranges
+
+
+def store_rows(
+    rows: list[list],
+    worksheet: gspread.worksheet.Worksheet,
+    previous: list[list] = None,
+    batch=None,
+):
+    """
+    Store rows under a header, rewriting the whole sheet unless the previously
+    stored rows are known, in which case only the rows that differ are written.
+    """
+    if previous is None or previous[:1] != rows[:1]:
+        worksheet.resize(len(rows), len(rows[0]))
+        upload_rows(worksheet, rows, batch)
+        worksheet.freeze(1, 0)
+        return
+
+    ranges = changed_row_ranges(previous, rows)
+    logging.info(
+        "Updating {} changed row ranges of {} rows".format(len(ranges), len(rows))
+    )
+    worksheet.resize(len(rows), len(rows[0]))
+    if ranges:
+        worksheet.batch_update(
+            [
+                {
+                    "range": "{}:{}".format(
+                        gspread.utils.rowcol_to_a1(start + 1, 1),
+                        gspread.utils.rowcol_to_a1(end, len(rows[0])),
+                    ),
+                    "values": rows[start:end],
+                }
+                for start, end in ranges
+            ],
+            value_input_option=gspread.utils.ValueInputOption.user_entered,
+        )
+
+
+def store_transactions(
+    transactions: list[list],
+    worksheet: gspread.worksheet.Worksheet,
+    previous: list[list] = None,
+    batch=None,
+):
+    logging.info("Storing transactions")
+    store_rows(transactions, worksheet, previous, batch)
+
+
+def build_activity(transactions: dict[str, list[list]], derived: dict) -> list[list]:
+    """
+    Build monthly activity totals per subcategory from the transaction rows of
+    every budget, keyed by currency with the main budget under HUF.
+
+    Split transactions are already one row per subtransaction. Amounts of the
+    extra currency budgets are converted to HUF with the hufValues of the
+    derived columns, shared by the rows with the same check number in
+    proportion to their amounts, so the subtransactions of a split don't each
+    count the whole HUF value. Transactions without a check number have no HUF
+    value.
+    """
+    import pandas as pd
+
+    frames = []
+    for currency, rows in transactions.items():
+        frame = pd.DataFrame(
+            [row[:5] for row in rows[1:]],
+            columns=["accountId", "date", "checkNumber", "categoryId", "amount"],
+        )
+        frame["currency"] = currency
+        if currency == "HUF":
+            frame["hufActivity"] = frame["amount"]
+        else:
+            by_check_number = frame.groupby("checkNumber")["amount"]
+            total = by_check_number.transform("sum")
+            # Rows adding up to zero share the HUF value equally
+            share = (frame["amount"] / total).where(
+                total != 0, 1 / by_check_number.transform("size")
+            )
+            frame["hufActivity"] = (
+                frame["checkNumber"].map(derived["hufValues"]).fillna(0) * share
+            )
+        frames.append(frame)
+
+    frame = pd.concat(frames, ignore_index=True)
+    # Transfers between budget accounts have no category
+    frame = frame[frame["categoryId"].fillna("") != ""]
+    frame["month"] = frame["date"].str[:8] + "01"
+    activity = (
+        frame.groupby(["month", "currency", "categoryId"], sort=True)[
+            ["amount", "hufActivity"]
+        ]
+        .sum()
+        .round(2)
+        .reset_index()
+        .rename(columns={"amount": "activity"})
+    )
+    activity.insert(
+        2,
+        "masterCategoryId",
+        activity["categoryId"].map(derived["masterCategories"]).fillna(""),
+    )
+    return [activity.columns.tolist()] + activity.values.tolist()
+
+
+def store_activity(
+    activity: list[list],
+    worksheet: gspread.worksheet.Worksheet,
+    previous: list[list] = None,
+    batch=None,
+):
+    """
+    Store the activity totals. Rows are ordered by month, so with the previous
+    rows known, changed totals are written in place, but a category row added
+    or removed shifts and rewrites every row after it.
+    """
+    logging.info("Storing activity")
+    store_rows(activity, worksheet, previous, batch)
+
+
+def shard_title(sheet: str, year: str) -> str:
+    return "{}/{}".format(sheet, year)
+
+
+def shard_transactions(transactions: list[list]) -> dict[str, list[list]]:
+    """Split the transaction rows by year, every shard starts with the header."""
+    shards = {}
+    for row in transactions[1:]:
+        shards.setdefault(row[1][:4], [transactions[0]]).append(row)
+    return dict(sorted(shards.items()))
+
+
+def store_transaction_index(
+    sheet: str, shards: dict[str, list[list]], worksheet: gspread.worksheet.Worksheet
+):
+    """
+    Turn the Transactions sheet into an index of its year shards.
+
+    Row 1 holds the column names and A2 a single formula stacking the data rows
+    of every shard, kept in sync with the shards on every sync, so formulas
+    reading the Transactions sheet keep working. The stacked rows take as many
+    cells as the shards, sharding saves rewriting unchanged years, not cells.
+    """
+    header = next(iter(shards.values()))[0] if shards else []
+    # Formula columns are named by the first string literal of the formula
+    names = [
+        re.search(r'"(\w+)"', name).group(1) if name.startswith("=") else name
+        for name in header
+    ]
+    last_column = re.sub(r"\d+$", "", gspread.utils.rowcol_to_a1(1, len(names) or 1))
+    stacked = ";".join(
+        "'{}'!A2:{}".format(shard_title(sheet, year), last_column) for year in shards
+    )
+    rows = sum(len(shard) - 1 for shard in shards.values())
+
+    logging.info("Storing index of {} shards of '{}'".format(len(shards), sheet))
     worksheet.clear()
-    worksheet.resize(len(transactions), len(transactions[0]))
-    worksheet.update(transactions, raw=False)
-    worksheet.freeze(1, 0)
+    worksheet.resize(max(rows, 1) + 1, max(len(names), 1))
+    if shards:
+        worksheet.update("A1", [names, ["={{{}}}".format(stacked)]], raw=False)
+        worksheet.freeze(1, 0)
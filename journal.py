@@ -0,0 +1,110 @@
+import json
+import logging
+import os
+
+JOURNAL_VERSION = 1
+
+
+class Journal(object):
+    """
+    Write-ahead journal of sync runs, kept in a small JSON file.
+
+    Records the completed stages of a run and the chunks written by pending
+    sheet uploads, so a run that failed halfway can be resumed by the next one
+    instead of starting over. Every change is saved immediately. Stages are
+    keyed by a value, like the market data fingerprint, and uploads by the
+    budget knowledge and table fingerprint they were built from, entries that
+    don't match are ignored.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.stages = {}
+        self.attempts = {}
+        self.batches = {}
+        try:
+            with open(filename, "r") as fp:
+                journal = json.load(fp)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning("Failed to load journal '{}': {}".format(filename, e))
+            return
+        if journal.get("version") != JOURNAL_VERSION:
+            return
+        self.stages = journal["stages"]
+        self.attempts = journal.get("attempts", {})
+        self.batches = journal["batches"]
+        if self.batches:
+            logging.info(
+                "Journal has pending writes for {}".format(list(self.batches.keys()))
+            )
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        tmp_filename = "{}.tmp".format(self.filename)
+        with open(tmp_filename, "w") as fp:
+            json.dump(
+                {
+                    "version": JOURNAL_VERSION,
+                    "stages": self.stages,
+                    "attempts": self.attempts,
+                    "batches": self.batches,
+                },
+                fp,
+            )
+        os.replace(tmp_filename, self.filename)
+
+    def is_completed(self, stage: str, key: str) -> bool:
+        return self.stages.get(stage) == key
+
+    def complete(self, stage: str, key: str):
+        self.stages[stage] = key
+        self.attempts.pop(stage, None)
+        self.save()
+
+    def attempt(self, stage: str, key: str) -> int:
+        """Count an attempt of a stage that couldn't complete, return the count."""
+        attempts = self.attempts.get(stage)
+        count = attempts[1] + 1 if attempts and attempts[0] == key else 1
+        self.attempts[stage] = [key, count]
+        self.save()
+        return count
+
+    def begin(self, sheet: str, knowledge: str, fingerprint: str) -> "WriteBatch":
+        """Start writing a sheet, resuming the pending write of the same rows."""
+        batch = self.batches.get(sheet)
+        if (
+            batch is None
+            or batch["knowledge"] != knowledge
+            or batch["fingerprint"] != fingerprint
+        ):
+            batch = {"knowledge": knowledge, "fingerprint": fingerprint, "chunks": []}
+            self.batches[sheet] = batch
+            self.save()
+        elif batch["chunks"]:
+            logging.info(
+                "Resuming write of '{}', {} chunks already written".format(
+                    sheet, len(batch["chunks"])
+                )
+            )
+        return WriteBatch(self, batch)
+
+    def end(self, sheet: str):
+        """The sheet was written and its fingerprint saved, forget the write."""
+        if self.batches.pop(sheet, None) is not None:
+            self.save()
+
+
+class WriteBatch(object):
+    """Chunks of rows, as (start, end) ranges, already written to a sheet."""
+
+    def __init__(self, journal: Journal, batch: dict):
+        self.journal = journal
+        self.batch = batch
+        self.committed = {tuple(chunk) for chunk in batch["chunks"]}
+
+    def commit(self, start: int, end: int):
+        self.committed.add((start, end))
+        self.batch["chunks"].append([start, end])
+        self.journal.save()
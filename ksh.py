@@ -1,113 +1,178 @@
 import csv
 import gspread
+import json
 import logging
+import os
 import requests
 
 from io import StringIO
+from session import http_session
 
 
-def fetch_data(url):
+def fetch_data(url, cache=None):
+    """
+    Fetch a KSH CSV file as a list of rows, raising if it failed.
+
+    With a cache dict the rows are kept there along with the response's ETag
+    and Last-Modified validators, and the file is only downloaded again if it
+    changed, otherwise the cached rows are returned.
+    """
+    cached = cache.get(url) if cache is not None else None
+    headers = {}
+    if cached is not None:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
     logging.info("Fetching KSH data from {}".format(url))
-    response = requests.get(url)
+    response = http_session().get(url, headers=headers)
+    if response.status_code == 304 and cached is not None:
+        logging.info("KSH data at {} is unchanged".format(url))
+        return cached["rows"]
 
-    try:
-        response.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        logging.error("Failed to fetch KSH data: {}".format(e))
-        return None
+    response.raise_for_status()
 
     data = response.text
     reader = csv.reader(StringIO(data), delimiter=";")
-    return list(reader)
+    rows = list(reader)
+    if cache is not None:
+        cache[url] = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "rows": rows,
+        }
+    return rows
+
+
+def load_cache(filename):
+    if filename is None:
+        return None
+    try:
+        with open(filename, "r") as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.warning("Failed to load KSH cache '{}': {}".format(filename, e))
+        return {}
 
 
-def update_inflation_rate(worksheet: gspread.worksheet.Worksheet):
-    url = "https://www.ksh.hu/stadat_files/ara/hu/ara0001.csv"
-    data = fetch_data(url)
-    if data is None:
+def save_cache(filename, cache):
+    if filename is None:
         return
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    tmp_filename = "{}.tmp".format(filename)
+    with open(tmp_filename, "w") as fp:
+        json.dump(cache, fp)
+    os.replace(tmp_filename, filename)
+
+
+def fetch_inflation_rates(cache_filename=None) -> list[list[str]]:
+    """
+    Fetch the yearly inflation rates as [year, rate] rows with decimal commas,
+    the current year estimated from its months so far.
+
+    With a cache file the KSH files are only downloaded when they changed.
+    """
+    cache = load_cache(cache_filename)
+    url = "https://www.ksh.hu/stadat_files/ara/hu/ara0001.csv"
+    data = fetch_data(url, cache)
 
     # Remove header
     data = data[2:]
     # We only need the first 2 columns
-    for i in range(len(data)):
-        data[i] = data[i][:2]
+    data = [row[:2] for row in data]
 
     next_year = int(data[len(data) - 1][0]) + 1
 
-    current_inflation = calculate_inflation_current_year(str(next_year))
+    current_inflation = calculate_inflation_current_year(str(next_year), cache)
     if current_inflation is not None:
         data.append(
             [str(next_year), str(round(current_inflation, 1)).replace(".", ",")]
         )
+    save_cache(cache_filename, cache)
+    return data
 
-    offset = 4
-    records = worksheet.get_values("A{}:B".format(offset))
-    # Convert records to a dictionary for easier comparison
-    dict1 = {row[0]: row[1] for row in records}
 
-    update_data = []
+def update_inflation_rate(worksheet: gspread.worksheet.Worksheet, cache_filename=None):
+    """
+    Update the yearly inflation rates in the sheet, return them as rows.
 
-    for row in data:
-        year, inflation = row[0], row[1]
-        if year not in dict1:
+    The sheet's years are indexed by row, and the changed and appended years
+    are written as a single contiguous block.
+    """
+    data = fetch_inflation_rates(cache_filename)
+
+    offset = 4
+    records = worksheet.get_values("A{}:B".format(offset))
+    # Index the sheet's years by row
+    rows = {row[0]: offset + i for i, row in enumerate(records) if row}
+    values = {row[0]: row[1] if len(row) > 1 else "" for row in records if row}
+
+    block = {}
+    next_row = len(records) + offset
+    for year, inflation in data:
+        if year not in rows:
             # Add as a new line to the sheet
-            r = len(records) + offset
-            update_data.append(
-                {"range": "A{}:B{}".format(r, r), "values": [[year, inflation]]}
-            )
-        elif dict1[year] != inflation:
-            # Find row and add to updates
+            block[next_row] = [year, inflation]
+            next_row += 1
+        elif values[year] != inflation:
             logging.info(
                 "Inflation rate for year {} changed from {} to {}".format(
-                    year, dict1[year], inflation
+                    year, values[year], inflation
                 )
             )
-            r = list(dict1.keys()).index(year) + offset
-            update_data.append(
-                {"range": "A{}:B{}".format(r, r), "values": [[year, inflation]]}
-            )
+            block[rows[year]] = [year, inflation]
 
-    logging.debug("Batch update data: {}".format(update_data))
-    if update_data:
-        worksheet.batch_update(
-            update_data, value_input_option=gspread.utils.ValueInputOption.user_entered
-        )
-        logging.info("KSH inflation data updated")
-    else:
+    if not block:
         logging.info("KSH inflation data is up to date")
+        return data
+
+    # Rows between the changed ones are rewritten with their current values
+    first, last = min(block), max(block)
+    update_data = [
+        block.get(r) or (records[r - offset] + ["", ""])[:2]
+        for r in range(first, last + 1)
+    ]
+    logging.debug("Update data: {}".format(update_data))
+    worksheet.update("A{}:B{}".format(first, last), update_data, raw=False)
+    logging.info("KSH inflation data updated in rows {}-{}".format(first, last))
+    return data
 
 
-def calculate_inflation_current_year(year):
+def calculate_inflation_current_year(year, cache=None):
     # Fetch data from the first URL
     url = "https://www.ksh.hu/stadat_files/ara/hu/ara0039.csv"
-    data = fetch_data(url)
-    if data is None:
+    try:
+        data = fetch_data(url, cache)
+    except requests.exceptions.RequestException as e:
+        # The estimate is optional, the past years are still updated
+        logging.error("Failed to fetch KSH data: {}".format(e))
         return None
 
     # Remove header
     data = data[2:]
 
-    # We only need the first 3 columns
-    for i in range(len(data)):
-        data[i] = data[i][:3]
+    # Years are in chronological blocks, only the requested year's block is
+    # parsed, found from the end as it's usually the current year
+    start = None
+    for i in range(len(data) - 1, -1, -1):
+        if data[i] and data[i][0].strip().replace(".", "") == year:
+            start = i
+            break
+    if start is None:
+        return None
 
     inflation_values = []
-    current_year = None
-
-    for row in data:
-        if row[0]:
-            current_year = row[0].strip().replace(".", "")
-        if not row[0] and current_year:
-            row[0] = current_year
-
-        if current_year != year:
-            continue
-
+    for i, row in enumerate(data[start:]):
+        if i > 0 and row and row[0].strip():
+            # Next year's block
+            break
         try:
             inflation = float(row[2].replace(",", "."))
             inflation_values.append(inflation)
-        except ValueError:
+        except (IndexError, ValueError):
             continue
 
     if not inflation_values:
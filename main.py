@@ -1,30 +1,29 @@
 import json
 import logging
+import os
+import re
 
-from config import init_config, get_config
-from datetime import datetime
-from dbx import find_latest_yfull
-from dropbox import Dropbox
-from dropbox.oauth import OAuth2FlowNoRedirectResult
-from gsheet import (
-    create_sheets,
-    store_budgets,
-    store_categories,
-    store_transactions,
-    is_knowledge_up_to_date,
-    update_saved_knowledge,
-)
-from gspread import oauth
-from ksh import update_inflation_rate
-from mnb import update_currency_rate
-from portfolio import update_portfolio_ratios
-import stocks
+from config import init_config, get_config, is_enabled
+from datetime import date, datetime, timedelta, timezone
+from profiling import stage
 
+# Heavy dependencies (dropbox, gspread, pandas, yfinance, lxml) are imported by
+# the stage that needs them, most runs are no-ops and exit on the fast path.
 
-if __name__ == "__main__":
-    init_config()
-    config = get_config()
-    logging.basicConfig(level=config["LOG_LEVEL"].upper())
+MARKET_DATA_KEY = "Market"
+# MNB publishes the day's exchange rates on weekdays before noon in Budapest
+MNB_PUBLISH_HOUR_UTC = 11
+# Runs waiting for the latest market data, which never comes on holidays
+MARKET_DATA_ATTEMPTS = 3
+
+
+class Incomplete(Exception):
+    """The data a market step fetches isn't published yet."""
+
+
+def init_dropbox(config):
+    from dropbox import Dropbox
+    from dropbox.oauth import OAuth2FlowNoRedirectResult
 
     logging.info("Initializing Dropbox")
     with open(config["DROPBOX_OAUTH_TOKEN_FILENAME"], "r") as fp:
@@ -37,7 +36,7 @@ if __name__ == "__main__":
             datetime.fromisoformat(token["expires_at"]),
             token["scope"],
         )
-        dbx = Dropbox(
+        return Dropbox(
             oauth2_access_token=dbx_oauth_token.access_token,
             oauth2_refresh_token=dbx_oauth_token.refresh_token,
             oauth2_access_token_expiration=dbx_oauth_token.expires_at,
@@ -46,48 +45,616 @@ if __name__ == "__main__":
             scope=dbx_oauth_token.scope.split(),
         )
 
+
+def init_google(config):
+    from gspread import oauth
+    from gsheet import REQUEST_TIMEOUT
+
     logging.info("Initializing Google")
     gc = oauth(
         credentials_filename=config["GSPREAD_CREDENTIALS_FILENAME"],
         authorized_user_filename=config["GSPREAD_AUTHORIZED_USER_FILENAME"],
     )
+    gc.set_timeout(REQUEST_TIMEOUT)
+    return gc
 
-    main_budget_data = find_latest_yfull(dbx, config["BUDGET"])
 
-    logging.info("Opening spreadsheet")
-    spreadsheet = gc.open(config["GSPREAD_SHEET_NAME"])
+def sync_budgets(config, dbx, registry, saved_fingerprints, snapshot, sinks, journal):
+    """Sync the main and extra currency budgets, return the extra budgets' data."""
+    from dbx import find_latest_yfull
+    from gsheet import (
+        build_activity,
+        build_tables,
+        build_transactions,
+        changed_tables,
+        delete_saved_fingerprints,
+        derived_columns,
+        fingerprint,
+        shard_title,
+        shard_transactions,
+        store_activity,
+        store_budgets,
+        store_categories,
+        store_transaction_index,
+        store_transactions,
+        is_knowledge_up_to_date,
+        table_fingerprints,
+        update_saved_fingerprints,
+        update_saved_knowledge,
+    )
+    from sinks import write_sheet
+    from snapshot import get_rows, set_rows
+
+    cache_directory = os.path.join(config["STATE_DIRECTORY"], "budgets")
+    # Transaction rows built in this run by currency, for the activity totals
+    transaction_rows = {}
+
+    def sync_table(data, sheet, fingerprint, rows, store):
+        with stage(store.__name__):
+            store(rows, registry.worksheet(sheet), begin(data, sheet, fingerprint))
+            write_sheet(sinks, sheet, rows)
+        commit_table(sheet, fingerprint, rows)
+
+    def sync_transactions(data, sheet, fingerprint, rows):
+        currency = sheet[len("YNAB/Transactions") :]
+        with stage("_".join(filter(None, ["store_transactions", currency]))):
+            transaction_rows[currency or "HUF"] = rows
+            if sharding:
+                sync_shards(data, sheet, rows)
+            else:
+                # Only the changed rows are written if the sheet matches the snapshot
+                previous = get_rows(snapshot, sheet, saved_fingerprints.get(sheet))
+                store_transactions(
+                    rows,
+                    registry.worksheet(sheet),
+                    previous,
+                    begin(data, sheet, fingerprint),
+                )
+                delete_shards(sheet, [])
+            write_sheet(sinks, sheet, rows)
+        # The rows of a sharded sheet live in its shards, not in the index
+        commit_table(sheet, fingerprint, None if sharding else rows)
+
+    def sync_shards(data, sheet, rows):
+        shards = {
+            shard_title(sheet, year): shard
+            for year, shard in shard_transactions(rows).items()
+        }
+        changed = changed_tables(
+            {shard: fingerprint(shard_rows) for shard, shard_rows in shards.items()},
+            saved_fingerprints,
+        )
+        registry.create_missing(
+            [{"name": shard, "rows": 1, "cols": len(rows[0])} for shard in changed]
+        )
+        for shard, shard_fingerprint in changed.items():
+            previous = get_rows(snapshot, shard, saved_fingerprints.get(shard))
+            store_transactions(
+                shards[shard],
+                registry.worksheet(shard),
+                previous,
+                begin(data, shard, shard_fingerprint),
+            )
+            commit_table(shard, shard_fingerprint, shards[shard])
+        delete_shards(sheet, shards)
+        store_transaction_index(
+            sheet,
+            {shard[len(sheet) + 1 :]: shards[shard] for shard in shards},
+            registry.worksheet(sheet),
+        )
+
+    def delete_shards(sheet, keep):
+        stale = [
+            shard
+            for shard in registry.titles("{}/".format(sheet))
+            if re.fullmatch(r"\d{4}", shard[len(sheet) + 1 :]) and shard not in keep
+        ]
+        registry.delete(stale)
+        delete_saved_fingerprints(registry.spreadsheet, saved_fingerprints, stale)
+
+    def sync_activity(extra_budgets):
+        with stage("store_activity"):
+            budgets = {"HUF": main_budget_data} | extra_budgets
+            for cur, data in budgets.items():
+                if cur not in transaction_rows:
+                    transaction_rows[cur] = build_transactions(data)
+            rows = build_activity(
+                transaction_rows, derived or derived_columns(main_budget_data)
+            )
+            activity_fingerprint = fingerprint(rows)
+            if saved_fingerprints.get("YNAB/Activity") == activity_fingerprint:
+                logging.info("Activity is up to date, skipping")
+                return
+            # Rows are ordered by month, unchanged months are not written
+            previous = get_rows(
+                snapshot, "YNAB/Activity", saved_fingerprints.get("YNAB/Activity")
+            )
+            store_activity(
+                rows,
+                registry.worksheet("YNAB/Activity"),
+                previous,
+                begin(main_budget_data, "YNAB/Activity", activity_fingerprint),
+            )
+            write_sheet(sinks, "YNAB/Activity", rows)
+        commit_table("YNAB/Activity", activity_fingerprint, rows)
+
+    def begin(data, sheet, fingerprint):
+        knowledge = data.get("fileMetaData").get("currentKnowledge")
+        return journal.begin(sheet, knowledge, fingerprint)
+
+    def commit_table(sheet, fingerprint, rows):
+        update_saved_fingerprints(
+            registry.spreadsheet, saved_fingerprints, {sheet: fingerprint}
+        )
+        journal.end(sheet)
+        set_rows(snapshot, sheet, fingerprint, rows)
+
+    with stage("find_latest_yfull"):
+        main_budget_data = find_latest_yfull(dbx, config["BUDGET"], cache_directory)
 
-    create_sheets(spreadsheet, list(config["BUDGET_EXTRA_TXN"].keys()))
-    if is_knowledge_up_to_date(
-        main_budget_data, spreadsheet.worksheet("YNAB/Transactions")
+    # Materialized columns make every Transactions sheet depend on the main
+    # budget, so a sheet's own knowledge can't tell whether it is up to date
+    materialize = is_enabled(config["MATERIALIZE_DERIVED_COLUMNS"])
+    derived = derived_columns(main_budget_data) if materialize else None
+    sharding = is_enabled(config["TRANSACTION_SHARDING"])
+
+    if not materialize and is_knowledge_up_to_date(
+        main_budget_data, registry.worksheet("YNAB/Transactions")
     ):
         logging.info("Sheet is up to date, skipping")
+        categories_changed = False
     else:
-        store_categories(main_budget_data, spreadsheet.worksheet("YNAB/Categories"))
-        store_budgets(main_budget_data, spreadsheet.worksheet("YNAB/Budgets"))
-        store_transactions(main_budget_data, spreadsheet.worksheet("YNAB/Transactions"))
-        update_saved_knowledge(
-            main_budget_data, spreadsheet.worksheet("YNAB/Transactions")
-        )
+        tables = build_tables(main_budget_data, derived=derived)
+        changed = changed_tables(table_fingerprints(tables, sharding), saved_fingerprints)
+        # Activity rows carry the master category of every category
+        categories_changed = "YNAB/Categories" in changed
+        for sheet, store in [
+            ("YNAB/Categories", store_categories),
+            ("YNAB/Budgets", store_budgets),
+        ]:
+            if sheet in changed:
+                sync_table(
+                    main_budget_data, sheet, changed[sheet], tables[sheet], store
+                )
+        if "YNAB/Transactions" in changed:
+            sync_transactions(
+                main_budget_data,
+                "YNAB/Transactions",
+                changed["YNAB/Transactions"],
+                tables["YNAB/Transactions"],
+            )
+        if changed or not materialize:
+            update_saved_knowledge(
+                main_budget_data, registry.worksheet("YNAB/Transactions")
+            )
 
-    stock = stocks.Stocks()
+    extra_budgets = {}
     for cur, budget in config["BUDGET_EXTRA_TXN"].items():
-        data = find_latest_yfull(dbx, budget)
-        if is_knowledge_up_to_date(
-            data, spreadsheet.worksheet("YNAB/Transactions{}".format(cur))
+        with stage("find_latest_yfull_{}".format(cur)):
+            data = find_latest_yfull(dbx, budget, cache_directory)
+        sheet = "YNAB/Transactions{}".format(cur)
+        if not materialize and is_knowledge_up_to_date(
+            data, registry.worksheet(sheet)
         ):
             logging.info("Sheet is up to date, skipping")
         else:
-            store_transactions(
-                data, spreadsheet.worksheet("YNAB/Transactions{}".format(cur))
+            tables = build_tables(data, cur, derived)
+            changed = changed_tables(
+                table_fingerprints(tables, sharding), saved_fingerprints
             )
-            update_saved_knowledge(
-                data, spreadsheet.worksheet("YNAB/Transactions{}".format(cur))
+            if sheet in changed:
+                sync_transactions(data, sheet, changed[sheet], tables[sheet])
+            if changed or not materialize:
+                update_saved_knowledge(data, registry.worksheet(sheet))
+        extra_budgets[cur] = data
+
+    if (
+        transaction_rows
+        or categories_changed
+        or "YNAB/Activity" not in saved_fingerprints
+    ):
+        sync_activity(extra_budgets)
+
+    return extra_budgets
+
+
+def budget_tables(config) -> list[str]:
+    """Names of the YNAB tables in the sinks."""
+    from sinks import sheet_table
+
+    sheets = ["YNAB/Categories", "YNAB/Budgets", "YNAB/Transactions", "YNAB/Activity"]
+    sheets += ["YNAB/Transactions{}".format(cur) for cur in config["BUDGET_EXTRA_TXN"]]
+    return [sheet_table(sheet) for sheet in sheets]
+
+
+def export_budgets(config, dbx, sinks) -> dict:
+    """
+    Write every YNAB table to the sinks only, without Google Sheets, return
+    the extra currency budgets.
+    """
+    from dbx import find_latest_yfull
+    from gsheet import build_activity, build_budgets, build_categories
+    from gsheet import build_transactions, derived_columns
+    from sinks import write_sheet
+
+    cache_directory = os.path.join(config["STATE_DIRECTORY"], "budgets")
+    with stage("find_latest_yfull"):
+        main_budget_data = find_latest_yfull(dbx, config["BUDGET"], cache_directory)
+    derived = None
+    if is_enabled(config["MATERIALIZE_DERIVED_COLUMNS"]):
+        derived = derived_columns(main_budget_data)
+
+    transaction_rows = {}
+    with stage("export_budgets"):
+        write_sheet(sinks, "YNAB/Categories", build_categories(main_budget_data))
+        write_sheet(sinks, "YNAB/Budgets", build_budgets(main_budget_data))
+        transaction_rows["HUF"] = build_transactions(main_budget_data, derived)
+        write_sheet(sinks, "YNAB/Transactions", transaction_rows["HUF"])
+    extra_budgets = {}
+    for cur, budget in config["BUDGET_EXTRA_TXN"].items():
+        with stage("find_latest_yfull_{}".format(cur)):
+            data = find_latest_yfull(dbx, budget, cache_directory)
+        extra_budgets[cur] = data
+        with stage("export_transactions_{}".format(cur)):
+            transaction_rows[cur] = build_transactions(data, derived)
+            write_sheet(
+                sinks, "YNAB/Transactions{}".format(cur), transaction_rows[cur]
+            )
+    with stage("export_activity"):
+        write_sheet(
+            sinks,
+            "YNAB/Activity",
+            build_activity(
+                transaction_rows, derived or derived_columns(main_budget_data)
+            ),
+        )
+    return extra_budgets
+
+
+def export_market_data(config, extra_budgets, sinks, journal):
+    """
+    Write stock prices, exchange and inflation rates to the sinks only,
+    fetched from their sources without Google Sheets.
+
+    Prices and rates are fetched from the day after the last one every sink
+    has, or from the first transaction of the extra budgets, so a new sink
+    gets the full history. Runs when new data is published or the portfolio
+    changes, like sync_market_data.
+    """
+    from gsheet import fingerprint
+    from ksh import fetch_inflation_rates
+    from mnb import fetch_rates, parse_rates
+    from sinks import inflation_frame, last, missing, prices_frame, rates_frame
+    from sinks import write_table
+    import stocks
+
+    stock = stocks.Stocks()
+    for cur, data in extra_budgets.items():
+        stock.add_to_portfolio(data, cur)
+
+    mnb_date, close_date = market_data_dates()
+    market_fingerprint = fingerprint([mnb_date, close_date, stock.portfolio])
+    if journal.is_completed(
+        "export_market_data", market_fingerprint
+    ) and not missing(sinks, ["prices", "fx", "inflation"]):
+        logging.info("Market data is up to date, skipping")
+        return
+
+    def next_day(value):
+        return (date.fromisoformat(value) + timedelta(days=1)).isoformat()
+
+    dates = [
+        txn["date"]
+        for data in extra_budgets.values()
+        for txn in data["transactions"]
+        if not txn.get("isTombstone", False)
+    ]
+    start = min(dates) if dates else close_date
+
+    with stage("export_prices"):
+        lasts = [last(sinks, "prices", "date", {"ticker": t}) for t in stock.portfolio]
+        since = next_day(min(lasts)) if lasts and None not in lasts else start
+        closes = stock.fetch_closes(since) if since <= close_date else None
+        if closes is not None:
+            write_table(sinks, "prices", prices_frame(closes), ["date", "ticker"])
+
+    for cur in extra_budgets.keys():
+        with stage("export_fx_{}".format(cur)):
+            last_date = last(sinks, "fx", "date", {"currency": cur})
+            since = next_day(last_date) if last_date is not None else start
+            if since > mnb_date:
+                continue
+            rates = parse_rates(fetch_rates(cur, date.fromisoformat(since)))
+            if rates:
+                frame = rates_frame(cur, rates)
+                write_table(sinks, "fx", frame, ["date", "currency"])
+
+    with stage("export_inflation"):
+        inflation = fetch_inflation_rates(
+            os.path.join(config["STATE_DIRECTORY"], "ksh.json")
+        )
+        write_table(sinks, "inflation", inflation_frame(inflation))
+
+    journal.complete("export_market_data", market_fingerprint)
+
+
+def backfill_market_data(config, registry, stock, extra_budgets, sinks):
+    """
+    Write the prices and rates already in the sheets to the sinks that don't
+    have them yet, later runs only add the newly fetched ones.
+    """
+    from sinks import inflation_frame, missing, prices_frame, rates_frame
+    from sinks import write_table
+
+    backfill = missing(sinks, ["prices"])
+    if backfill:
+        archive_worksheet = None
+        if config["YFINANCE_DAILY_WINDOW_DAYS"]:
+            archive_worksheet = registry.worksheet("yfinance/archive")
+        closes = stock.read_prices(registry.worksheet("yfinance"), archive_worksheet)
+        if not closes.empty:
+            write_table(backfill, "prices", prices_frame(closes), ["date", "ticker"])
+
+    rates = None
+    for cur in extra_budgets.keys():
+        backfill = [
+            sink
+            for sink in sinks
+            if sink.last("fx", "date", {"currency": cur}) is None
+        ]
+        if not backfill:
+            continue
+        if rates is None:
+            rates = stock.read_rates(registry.worksheet("MNB"))
+        series = rates[cur].dropna() if cur in rates.columns else []
+        if not len(series):
+            continue
+        frame = rates_frame(
+            cur, list(zip(series.index.strftime("%Y-%m-%d"), series.tolist()))
+        )
+        write_table(backfill, "fx", frame, ["date", "currency"])
+
+    backfill = missing(sinks, ["inflation"])
+    if backfill:
+        rows = registry.worksheet("KSH").get_values("A4:B")
+        rows = [row for row in rows if row and row[0]]
+        write_table(backfill, "inflation", inflation_frame(rows))
+
+
+def last_weekday(day: date) -> date:
+    return day - timedelta(days=max(0, day.weekday() - 4))
+
+
+def market_data_dates() -> tuple[str, str]:
+    """
+    The dates of the latest published market data: the MNB exchange rates and
+    the stock closes, yfinance is queried until today, which excludes it.
+    """
+    now = datetime.now(timezone.utc)
+    mnb_date = now.date()
+    if now.hour < MNB_PUBLISH_HOUR_UTC:
+        mnb_date -= timedelta(days=1)
+    close_date = last_weekday(now.date() - timedelta(days=1))
+    return last_weekday(mnb_date).isoformat(), close_date.isoformat()
+
+
+def sync_market_data(
+    config, registry, saved_fingerprints, extra_budgets, sinks, journal
+):
+    """
+    Update stock prices, exchange and inflation rates and portfolio ratios.
+
+    Runs when new data is published or the portfolio changes, the dates of
+    the latest MNB rates and stock closes and the portfolio are the market data
+    fingerprint. It is only saved when every step succeeded and the sheets
+    reached those dates, otherwise the next run tries again. As there are no
+    rates or closes on holidays, a step is taken as complete after
+    MARKET_DATA_ATTEMPTS runs that found no data for the expected date. Completed steps
+    are journaled with the fingerprint up to the first failed one, where the
+    next run resumes.
+    """
+    from gsheet import fingerprint, update_saved_fingerprints
+    import stocks
+
+    stock = stocks.Stocks(os.path.join(config["STATE_DIRECTORY"], "quotes.json"))
+    with stage("add_to_portfolio"):
+        for cur, data in extra_budgets.items():
+            stock.add_to_portfolio(data, cur)
+
+    if sinks:
+        with stage("backfill_market_data"):
+            backfill_market_data(config, registry, stock, extra_budgets, sinks)
+
+    mnb_date, close_date = market_data_dates()
+    market_fingerprint = fingerprint([mnb_date, close_date, stock.portfolio])
+    if saved_fingerprints.get(MARKET_DATA_KEY) == market_fingerprint:
+        logging.info("Market data is up to date, skipping")
+        return
+
+    from functools import partial
+    from ksh import update_inflation_rate
+    from mnb import update_currency_rate
+    from portfolio import update_portfolio_ratios
+    from sinks import inflation_frame, prices_frame, rates_frame, write_table
+
+    failed = []
+
+    def run(step, func):
+        if journal.is_completed(step, market_fingerprint):
+            logging.info("'{}' was completed by an earlier run".format(step))
+            return
+        try:
+            with stage(step):
+                func()
+        except Incomplete as e:
+            attempts = journal.attempt(step, market_fingerprint)
+            if attempts < MARKET_DATA_ATTEMPTS:
+                logging.info("'{}' is incomplete: {}".format(step, e))
+                failed.append(step)
+                return
+            # Likely a holiday, the data is taken as complete
+            logging.info(
+                "'{}' is still incomplete after {} attempts: {}".format(
+                    step, attempts, e
+                )
             )
-        stock.add_to_portfolio(data)
+        except Exception:
+            logging.exception("'{}' failed".format(step))
+            failed.append(step)
+            return
+        # Later steps may depend on the failed ones, so they are retried too
+        if not failed:
+            journal.complete(step, market_fingerprint)
+
+    def currency_rate(cur):
+        last_date, rates = update_currency_rate(cur, registry.worksheet("MNB"))
+        if sinks and rates:
+            write_table(sinks, "fx", rates_frame(cur, rates), ["date", "currency"])
+        if last_date is not None and last_date < mnb_date:
+            raise Incomplete("MNB rates until {}".format(last_date))
+
+    def historical_rates():
+        closes = stock.get_historical_rates(registry.worksheet("yfinance"))
+        if sinks and closes is not None:
+            write_table(sinks, "prices", prices_frame(closes), ["date", "ticker"])
+        if stock.last_date is not None and stock.last_date < close_date:
+            raise Incomplete("closes until {}".format(stock.last_date))
+
+    def inflation_rate():
+        inflation = update_inflation_rate(
+            registry.worksheet("KSH"),
+            os.path.join(config["STATE_DIRECTORY"], "ksh.json"),
+        )
+        if sinks and inflation:
+            write_table(sinks, "inflation", inflation_frame(inflation))
+
+    for cur in extra_budgets.keys():
+        run("update_currency_rate_{}".format(cur), partial(currency_rate, cur))
+
+    archive_worksheet = None
+    if config["YFINANCE_DAILY_WINDOW_DAYS"]:
+        archive_worksheet = registry.worksheet("yfinance/archive")
+        run(
+            "compact_history",
+            partial(
+                stock.compact_history,
+                registry.worksheet("yfinance"),
+                archive_worksheet,
+                int(config["YFINANCE_DAILY_WINDOW_DAYS"]),
+                config["YFINANCE_ARCHIVE_FREQUENCY"],
+            ),
+        )
+    run("get_historical_rates", historical_rates)
+    run(
+        "update_valuation",
+        partial(
+            stock.update_valuation,
+            registry.worksheet("yfinance"),
+            registry.worksheet("MNB"),
+            registry.worksheet("Valuation"),
+            archive_worksheet,
+        ),
+    )
+    run(
+        "update_portfolio_ratios",
+        partial(update_portfolio_ratios, registry.worksheet("Portfolio")),
+    )
+    run("update_inflation_rate", inflation_rate)
+    if failed:
+        logging.warning("Market data steps {} will be retried".format(failed))
+        return
+    update_saved_fingerprints(
+        registry.spreadsheet,
+        saved_fingerprints,
+        {MARKET_DATA_KEY: market_fingerprint},
+    )
+
+
+def main():
+    init_config()
+    config = get_config()
+    logging.basicConfig(level=config["LOG_LEVEL"].upper())
+
+    if config["CASSETTE_MODE"]:
+        import atexit
+        import shutil
+        import tempfile
+        from cassette import Cassette
+
+        Cassette(config["CASSETTE_FILENAME"], config["CASSETTE_MODE"]).install()
+        # Recorded and replayed runs start from an empty state, so replay makes
+        # the same requests as the recorded run whatever state was left behind
+        config["STATE_DIRECTORY"] = tempfile.mkdtemp(prefix="ynab4-to-gsheet-")
+        atexit.register(shutil.rmtree, config["STATE_DIRECTORY"], True)
+
+    if config["PROFILE_DIRECTORY"]:
+        import profiling
+
+        profiling.configure(config["PROFILE_DIRECTORY"])
+
+    from sinks import create_sinks
+
+    sinks = create_sinks(config["OUTPUT_SINKS"])
+
+    from journal import Journal
+    from session import DropboxToken, GoogleToken, Refresher, TokenStore
 
-        update_currency_rate(cur, spreadsheet.worksheet("MNB"))
+    # Access tokens are reused across runs and refreshed ahead of expiry
+    token_store = TokenStore(os.path.join(config["STATE_DIRECTORY"], "tokens.json"))
+    # Cassette runs refresh them up front, so replay makes the recorded requests
+    reuse = not config["CASSETTE_MODE"]
+    dbx = init_dropbox(config)
+    if not config.get("GSPREAD_SHEET_NAME"):
+        if not sinks:
+            raise ValueError("Either GSPREAD_SHEET_NAME or OUTPUT_SINKS must be set")
+        logging.info("No spreadsheet configured, writing to the sinks only")
+        Refresher(token_store, [DropboxToken(dbx)], reuse).start()
+        extra_budgets = export_budgets(config, dbx, sinks)
+        export_market_data(
+            config,
+            extra_budgets,
+            sinks,
+            Journal(os.path.join(config["STATE_DIRECTORY"], "journal.json")),
+        )
+        return
+
+    gc = init_google(config)
+    Refresher(token_store, [DropboxToken(dbx), GoogleToken(gc.auth)], reuse).start()
+
+    from gsheet import SheetRegistry, create_sheets, get_saved_fingerprints
+
+    logging.info("Opening spreadsheet")
+    registry = SheetRegistry(gc.open(config["GSPREAD_SHEET_NAME"]))
+
+    with stage("create_sheets"):
+        create_sheets(
+            registry,
+            list(config["BUDGET_EXTRA_TXN"].keys()),
+            bool(config["YFINANCE_DAILY_WINDOW_DAYS"]),
+        )
+    saved_fingerprints = get_saved_fingerprints(registry)
+
+    from sinks import missing
 
-    stock.get_historical_rates(spreadsheet.worksheet("yfinance"))
-    update_portfolio_ratios(spreadsheet.worksheet("Portfolio"))
-    update_inflation_rate(spreadsheet.worksheet("KSH"))
+    # Sinks added to an existing sheet get every YNAB table once
+    backfill = missing(sinks, budget_tables(config))
+    if backfill:
+        logging.info("Backfilling the YNAB tables of {} sinks".format(len(backfill)))
+        export_budgets(config, dbx, backfill)
+
+    from snapshot import load_snapshot, save_snapshot
+
+    journal = Journal(os.path.join(config["STATE_DIRECTORY"], "journal.json"))
+    snapshot_filename = os.path.join(config["STATE_DIRECTORY"], "snapshot.pkl.gz")
+    snapshot = load_snapshot(snapshot_filename)
+    extra_budgets = sync_budgets(
+        config, dbx, registry, saved_fingerprints, snapshot, sinks, journal
+    )
+    save_snapshot(snapshot_filename, snapshot)
+    sync_market_data(
+        config, registry, saved_fingerprints, extra_budgets, sinks, journal
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,16 @@
 import gspread
 import logging
 import re
-import requests
 
 from datetime import datetime, timedelta
-from lxml import etree
+from session import http_session
 
 
-def update_currency_rate(currency: str, worksheet: gspread.worksheet.Worksheet):
-    column = worksheet.find(currency, 1)
-    if column is None:
-        logging.warning("Currency {} not found in MNB sheet".format(currency))
-        return
-
-    column = column.col
-    last_row = worksheet.findall(re.compile(r"^.+$"), in_column=column)[-1].row
-
-    last_date = worksheet.get(gspread.utils.rowcol_to_a1(last_row, 1))[0][0]
-    from_date = datetime.strptime(last_date, "%Y.%m.%d.").date() + timedelta(days=1)
+def fetch_rates(currency: str, from_date) -> list[tuple[str, str]]:
+    """
+    Fetch the MNB rates of a currency from a date until today, as (date, rate)
+    pairs of the texts shown by MNB, like ("2024.01.02.", "382,15").
+    """
     to_date = datetime.today().strftime("%Y.%m.%d.")
 
     url = "https://www.mnb.hu/arfolyam-tablazat"
@@ -34,15 +27,55 @@ def update_currency_rate(currency: str, worksheet: gspread.worksheet.Worksheet):
             currency, from_date, to_date
         )
     )
-    response = requests.get(url, params=params)
-    try:
-        response.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        logging.error("Failed to fetch MNB data: {}".format(e))
-        return
+    response = http_session().get(url, params=params)
+    # Failures are raised, so the step is retried by the next run
+    response.raise_for_status()
+
+    from lxml import etree
 
     root = etree.HTML(response.text)
-    content = root.xpath("//table[1]/tbody/tr")
+    return [
+        (elem.getchildren()[0].text, elem.getchildren()[1].text)
+        for elem in root.xpath("//table[1]/tbody/tr")
+    ]
+
+
+def parse_rates(content: list[tuple[str, str]]) -> list[tuple[str, float]]:
+    """Convert fetched rates to (date, rate) pairs with ISO dates."""
+    rates = []
+    for mnb_date, rate in content:
+        try:
+            rates.append(
+                (
+                    datetime.strptime(mnb_date, "%Y.%m.%d.").date().isoformat(),
+                    float(rate.replace(",", ".")),
+                )
+            )
+        except ValueError:
+            continue
+    return rates
+
+
+def update_currency_rate(
+    currency: str, worksheet: gspread.worksheet.Worksheet
+) -> tuple[str, list[tuple[str, float]]]:
+    """
+    Append the new MNB rates to the sheet.
+
+    Returns the sheet's last rate date and the new rates as (date, rate) pairs,
+    with ISO dates.
+    """
+    column = worksheet.find(currency, 1)
+    if column is None:
+        logging.warning("Currency {} not found in MNB sheet".format(currency))
+        return None, []
+
+    column = column.col
+    last_row = worksheet.findall(re.compile(r"^.+$"), in_column=column)[-1].row
+
+    last_date = worksheet.get(gspread.utils.rowcol_to_a1(last_row, 1))[0][0]
+    from_date = datetime.strptime(last_date, "%Y.%m.%d.").date() + timedelta(days=1)
+    content = fetch_rates(currency, from_date)
 
     if last_row + len(content) > worksheet.row_count:
         logging.info("Adding additional {} rows to MNB sheet".format(len(content)))
@@ -50,9 +83,7 @@ def update_currency_rate(currency: str, worksheet: gspread.worksheet.Worksheet):
 
     update_data = []
 
-    for i, elem in enumerate(content, start=1):
-        mnb_date = elem.getchildren()[0].text
-        rate = elem.getchildren()[1].text
+    for i, (mnb_date, rate) in enumerate(content, start=1):
         update_data.append(
             {
                 "range": gspread.utils.rowcol_to_a1(last_row + i, 2),
@@ -66,6 +97,7 @@ def update_currency_rate(currency: str, worksheet: gspread.worksheet.Worksheet):
             }
         )
 
+    rates = parse_rates(content)
     logging.debug("Batch update data: {}".format(update_data))
     if update_data:
         worksheet.batch_update(
@@ -73,3 +105,5 @@ def update_currency_rate(currency: str, worksheet: gspread.worksheet.Worksheet):
         )
 
     logging.info("MNB data for {} updated".format(currency))
+    last_date = datetime.strptime(last_date, "%Y.%m.%d.").date().isoformat()
+    return max([last_date] + [rate_date for rate_date, _ in rates]), rates
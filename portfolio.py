@@ -1,7 +1,8 @@
 import csv
 import gspread
 import logging
-import requests
+
+from session import http_session
 
 PORTFOLIO_REGIONS = [
     "USA",
@@ -15,7 +16,7 @@ PORTFOLIO_REGIONS = [
 
 def get_ratios(overhead=0.1):
     url = "https://marketcaps.site/indices.csv"
-    r = requests.get(url)
+    r = http_session().get(url)
     r.raise_for_status()
     text = r.iter_lines(decode_unicode=True)
     reader = csv.reader(text, delimiter=",")
@@ -31,11 +32,8 @@ def get_ratios(overhead=0.1):
 
 
 def update_portfolio_ratios(worksheet: gspread.worksheet.Worksheet):
-    try:
-        ratios = get_ratios()
-    except requests.exceptions.RequestException as e:
-        logging.error("Failed to fetch portfolio ratios: {}".format(e))
-        return
+    # Failures are raised, so the step is retried by the next run
+    ratios = get_ratios()
 
     logging.info("Updating portfolio ratios: {}".format(ratios))
 
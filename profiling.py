@@ -0,0 +1,112 @@
+import cProfile
+import logging
+import os
+import re
+import threading
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+
+TOP_ALLOCATIONS = 25
+# How often traced memory is sampled for peaks, in seconds
+PEAK_INTERVAL = 0.05
+# A new peak is only snapshotted when it is this much above the last one
+PEAK_GROWTH = 1.1
+
+_directory = None
+
+
+class PeakSampler(threading.Thread):
+    """
+    Snapshot traced memory near its peak, sampled in the background.
+
+    Snapshots taken at the end of a stage miss memory that the stage allocated
+    and freed, this keeps the snapshot of the highest sampled peak instead.
+    """
+
+    def __init__(self):
+        super().__init__(name="peak-sampler", daemon=True)
+        self.snapshot = None
+        self.size = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(PEAK_INTERVAL):
+            self.sample()
+
+    def sample(self):
+        current, _ = tracemalloc.get_traced_memory()
+        if self.snapshot is None or current > self.size * PEAK_GROWTH:
+            self.snapshot = tracemalloc.take_snapshot()
+            self.size = current
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        # Catch a peak at the very end of the stage
+        self.sample()
+
+
+def configure(directory: str):
+    """Enable profiling, every stage dumps its profiles into directory."""
+    global _directory
+    os.makedirs(directory, exist_ok=True)
+    _directory = directory
+    logging.info("Profiling enabled, writing profiles to '{}'".format(directory))
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Profile a stage of the sync with cProfile and tracemalloc if enabled.
+
+    Writes <name>.prof, readable with pstats or snakeviz, and <name>.mem.txt
+    with the peak traced memory, the largest allocations by line at the
+    highest sampled peak and those still alive at the end of the stage.
+    Peaks are sampled every PEAK_INTERVAL, shorter lived spikes can be
+    missed. Stages must not be nested.
+    """
+    if _directory is None:
+        yield
+        return
+
+    filename = os.path.join(_directory, re.sub(r"[^\w.-]", "_", name))
+    profile = cProfile.Profile()
+    tracemalloc.start()
+    sampler = PeakSampler()
+    sampler.start()
+    start = time.perf_counter()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        elapsed = time.perf_counter() - start
+        sampler.stop()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        profile.dump_stats("{}.prof".format(filename))
+        exclude = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        tables = [
+            (
+                "at the sampled peak of {:.1f} KiB".format(sampler.size / 1024),
+                sampler.snapshot.filter_traces(exclude),
+            ),
+            ("at the end of the stage", snapshot.filter_traces(exclude)),
+        ]
+        with open("{}.mem.txt".format(filename), "w") as fp:
+            fp.write("Stage: {}\n".format(name))
+            fp.write("Elapsed: {:.3f} s\n".format(elapsed))
+            fp.write("Peak traced memory: {:.1f} KiB\n".format(peak / 1024))
+            for title, table in tables:
+                fp.write("\nTop {} allocations {}:\n".format(TOP_ALLOCATIONS, title))
+                for stat in table.statistics("lineno")[:TOP_ALLOCATIONS]:
+                    fp.write("{}\n".format(stat))
+        logging.info(
+            "Profiled '{}': {:.3f} s, peak memory {:.1f} KiB".format(
+                name, elapsed, peak / 1024
+            )
+        )
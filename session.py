@@ -0,0 +1,226 @@
+import atexit
+import copy
+import hashlib
+import json
+import logging
+import os
+import requests
+import threading
+import time
+
+from datetime import datetime, timedelta, timezone
+
+# Tokens are refreshed this long before they expire, the Google client would
+# refresh on its own from 3m45s before expiry, blocking the request
+REFRESH_MARGIN = timedelta(minutes=5)
+# Wait before retrying a failed background refresh
+RETRY_INTERVAL = 60
+
+_http = None
+
+
+def http_session() -> requests.Session:
+    """
+    Return the requests session shared by the plain HTTP data sources (MNB, KSH
+    and the portfolio ratios), keeping connections alive across stages.
+    """
+    global _http
+    if _http is None:
+        _http = requests.Session()
+    return _http
+
+
+def utcnow() -> datetime:
+    # Naive UTC, like the expiry of the Dropbox and Google clients
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class DropboxToken(object):
+    name = "dropbox"
+
+    def __init__(self, dbx):
+        self.dbx = dbx
+
+    # The SDK has no public accessors for its current token
+    @property
+    def refresh_token(self) -> str:
+        return self.dbx._oauth2_refresh_token
+
+    @property
+    def expiry(self) -> datetime:
+        return self.dbx._oauth2_access_token_expiration
+
+    @property
+    def access_token(self) -> str:
+        return self.dbx._oauth2_access_token
+
+    def restore(self, access_token: str, expiry: datetime):
+        self.dbx._oauth2_access_token = access_token
+        self.dbx._oauth2_access_token_expiration = expiry
+
+    def refresh(self):
+        dbx = copy.copy(self.dbx)
+        dbx.refresh_access_token()
+        self.restore(dbx._oauth2_access_token, dbx._oauth2_access_token_expiration)
+
+
+class GoogleToken(object):
+    name = "google"
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+
+    @property
+    def refresh_token(self) -> str:
+        return self.credentials.refresh_token
+
+    @property
+    def expiry(self) -> datetime:
+        return self.credentials.expiry
+
+    @property
+    def access_token(self) -> str:
+        return self.credentials.token
+
+    def restore(self, access_token: str, expiry: datetime):
+        self.credentials.token = access_token
+        self.credentials.expiry = expiry
+
+    def refresh(self):
+        from google.auth.transport.requests import Request
+
+        credentials = copy.copy(self.credentials)
+        credentials.refresh(Request())
+        self.restore(credentials.token, credentials.expiry)
+
+
+class TokenStore(object):
+    """
+    Access tokens with their expiry, persisted so the next run can reuse them
+    instead of refreshing them again.
+
+    Only access tokens are stored, with a hash of the refresh token they were
+    issued for, the long-lived secrets stay in the configured files.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._lock = threading.Lock()
+        try:
+            with open(filename, "r") as fp:
+                self.tokens = json.load(fp)
+        except FileNotFoundError:
+            self.tokens = {}
+        except (OSError, ValueError) as e:
+            logging.warning("Failed to load tokens '{}': {}".format(filename, e))
+            self.tokens = {}
+
+    @staticmethod
+    def _hash(refresh_token: str) -> str:
+        return hashlib.sha256((refresh_token or "").encode()).hexdigest()
+
+    def restore(self, token) -> bool:
+        """Restore a stored token if it is not about to expire."""
+        stored = self.tokens.get(token.name)
+        if stored is None or stored["refresh_token"] != self._hash(
+            token.refresh_token
+        ):
+            return False
+        expiry = datetime.fromisoformat(stored["expiry"])
+        if expiry - REFRESH_MARGIN <= utcnow():
+            return False
+        token.restore(stored["access_token"], expiry)
+        logging.info("Reusing {} access token until {}".format(token.name, expiry))
+        return True
+
+    def save(self, token):
+        if token.access_token is None or token.expiry is None:
+            return
+        with self._lock:
+            stored = {
+                "access_token": token.access_token,
+                "expiry": token.expiry.isoformat(),
+                "refresh_token": self._hash(token.refresh_token),
+            }
+            if self.tokens.get(token.name) == stored:
+                return
+            self.tokens[token.name] = stored
+            os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+            tmp_filename = "{}.tmp".format(self.filename)
+            fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as fp:
+                json.dump(self.tokens, fp)
+            os.replace(tmp_filename, self.filename)
+
+
+class Refresher(threading.Thread):
+    """
+    Keeps access tokens fresh for the lifetime of the process.
+
+    Stored tokens are restored up front, or the clients' own tokens are kept
+    if they are still valid, the rest are refreshed. Then a daemon thread
+    refreshes them in the background ahead of their expiry, so long running
+    syncs never wait on a refresh. Every refreshed token is persisted, tokens
+    the clients refreshed on their own are persisted on exit.
+
+    The clients are shared with the upload threads, so tokens are refreshed on
+    a copy of the client and swapped in afterwards. Requests in flight keep
+    using the old token, which is valid until well after the swap. Without
+    reuse, e.g. when recording or replaying a cassette, tokens are always
+    refreshed up front so every run makes the same requests.
+    """
+
+    def __init__(self, store: TokenStore, tokens: list, reuse: bool = True):
+        super().__init__(name="token-refresher", daemon=True)
+        self.store = store
+        self.tokens = tokens
+        self.reuse = reuse
+
+    def start(self):
+        for token in self.tokens:
+            if not self.reuse:
+                self._refresh(token)
+            elif self.store.restore(token):
+                continue
+            elif (
+                token.access_token is not None
+                and token.expiry is not None
+                and token.expiry - REFRESH_MARGIN > utcnow()
+            ):
+                logging.info(
+                    "Using {} access token until {}".format(token.name, token.expiry)
+                )
+                self.store.save(token)
+            else:
+                self._refresh(token)
+        atexit.register(self.persist)
+        super().start()
+
+    def persist(self):
+        for token in self.tokens:
+            self.store.save(token)
+
+    def _refresh(self, token):
+        logging.info("Refreshing {} access token".format(token.name))
+        token.refresh()
+        self.store.save(token)
+
+    def run(self):
+        # Tokens without an expiry never need refreshing
+        tokens = [token for token in self.tokens if token.expiry is not None]
+        while tokens:
+            due = min(token.expiry - REFRESH_MARGIN for token in tokens)
+            wait = (due - utcnow()).total_seconds()
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            for token in tokens:
+                if token.expiry - REFRESH_MARGIN > utcnow():
+                    continue
+                try:
+                    self._refresh(token)
+                except Exception as e:
+                    logging.warning(
+                        "Failed to refresh {} access token: {}".format(token.name, e)
+                    )
+                    time.sleep(RETRY_INTERVAL)
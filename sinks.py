@@ -0,0 +1,310 @@
+import logging
+import os
+import sqlite3
+
+from abc import ABC, abstractmethod
+from importlib.util import find_spec
+from urllib.parse import urlsplit
+
+
+class Sink(ABC):
+    """
+    Local output for the synced tables, next to or instead of Google Sheets.
+
+    Tables are written as whole DataFrames. Without keys a table is replaced,
+    with keys rows are upserted: existing rows with the same key values are
+    overwritten and the rest are kept, for incrementally fetched data.
+    """
+
+    @abstractmethod
+    def write(self, table: str, frame, keys: list[str] = None):
+        pass
+
+    @abstractmethod
+    def exists(self, table: str) -> bool:
+        pass
+
+    @abstractmethod
+    def last(self, table: str, column: str, where: dict = None):
+        """Return the largest value of a column, None if there are no rows."""
+
+
+class SQLiteSink(Sink):
+    def __init__(self, filename: str):
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        self.filename = filename
+
+    def write(self, table: str, frame, keys: list[str] = None):
+        with sqlite3.connect(self.filename) as connection:
+            if keys is None or not self._exists(connection, table):
+                frame.to_sql(table, connection, if_exists="replace", index=False)
+                if keys is not None:
+                    connection.execute(
+                        'CREATE UNIQUE INDEX "{0}_key" ON "{0}" ({1})'.format(
+                            table, ", ".join('"{}"'.format(key) for key in keys)
+                        )
+                    )
+                return
+
+            staging = "{}_staging".format(table)
+            frame.to_sql(staging, connection, if_exists="replace", index=False)
+            columns = ", ".join('"{}"'.format(column) for column in frame.columns)
+            connection.execute(
+                'INSERT OR REPLACE INTO "{}" ({}) SELECT {} FROM "{}"'.format(
+                    table, columns, columns, staging
+                )
+            )
+            connection.execute('DROP TABLE "{}"'.format(staging))
+
+    @staticmethod
+    def _exists(connection, table: str) -> bool:
+        return (
+            connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                (table,),
+            ).fetchone()
+            is not None
+        )
+
+    def exists(self, table: str) -> bool:
+        with sqlite3.connect(self.filename) as connection:
+            return self._exists(connection, table)
+
+    def last(self, table: str, column: str, where: dict = None):
+        where = where or {}
+        with sqlite3.connect(self.filename) as connection:
+            if not self._exists(connection, table):
+                return None
+            return connection.execute(
+                'SELECT MAX("{}") FROM "{}"{}'.format(
+                    column,
+                    table,
+                    "".join(
+                        '{} "{}" = ?'.format("AND" if i else " WHERE", key)
+                        for i, key in enumerate(where)
+                    ),
+                ),
+                tuple(where.values()),
+            ).fetchone()[0]
+
+
+class FileSink(Sink):
+    """A file per table in a directory, upserts read and rewrite the file."""
+
+    extension = None
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def _filename(self, table: str) -> str:
+        return os.path.join(self.directory, "{}.{}".format(table, self.extension))
+
+    def write(self, table: str, frame, keys: list[str] = None):
+        import pandas as pd
+
+        filename = self._filename(table)
+        if keys is not None and os.path.exists(filename):
+            frame = pd.concat([self._read(filename), frame], ignore_index=True)
+            frame = frame.drop_duplicates(subset=keys, keep="last")
+            frame = frame.sort_values(keys, ignore_index=True)
+
+        tmp_filename = "{}.tmp".format(filename)
+        self._write(frame, tmp_filename)
+        os.replace(tmp_filename, filename)
+
+    def exists(self, table: str) -> bool:
+        return os.path.exists(self._filename(table))
+
+    def last(self, table: str, column: str, where: dict = None):
+        if not self.exists(table):
+            return None
+        frame = self._read(self._filename(table))
+        for key, value in (where or {}).items():
+            frame = frame[frame[key] == value]
+        return frame[column].max() if len(frame) else None
+
+    @abstractmethod
+    def _read(self, filename: str):
+        pass
+
+    @abstractmethod
+    def _write(self, frame, filename: str):
+        pass
+
+
+class ParquetSink(FileSink):
+    extension = "parquet"
+
+    def __init__(self, directory: str):
+        # Optional, pyarrow has no wheels for the Alpine based image
+        if find_spec("pyarrow") is None and find_spec("fastparquet") is None:
+            raise ValueError("The parquet sink needs pyarrow or fastparquet")
+        super().__init__(directory)
+
+    def _read(self, filename):
+        import pandas as pd
+
+        return pd.read_parquet(filename)
+
+    def _write(self, frame, filename):
+        frame.to_parquet(filename, index=False)
+
+
+class CSVSink(FileSink):
+    extension = "csv"
+
+    def _read(self, filename):
+        import pandas as pd
+
+        return pd.read_csv(filename, keep_default_na=False)
+
+    def _write(self, frame, filename):
+        frame.to_csv(filename, index=False)
+
+
+SINKS = {
+    "sqlite": SQLiteSink,
+    "parquet": ParquetSink,
+    "csv": CSVSink,
+}
+
+
+def create_sinks(urls: str) -> list[Sink]:
+    """
+    Create sinks from a comma separated list of URLs like sqlite:///data/ynab.db,
+    parquet:///data/parquet or csv://relative/directory.
+    """
+    sinks = []
+    for url in filter(None, (url.strip() for url in urls.split(","))):
+        parts = urlsplit(url)
+        if parts.scheme not in SINKS:
+            raise ValueError("Unknown output sink: {}".format(url))
+        path = parts.netloc + parts.path
+        logging.info("Writing tables to {} sink at '{}'".format(parts.scheme, path))
+        sinks.append(SINKS[parts.scheme](path))
+    return sinks
+
+
+def write_table(sinks: list[Sink], table: str, frame, keys: list[str] = None):
+    for sink in sinks:
+        sink.write(table, frame, keys)
+    if sinks:
+        logging.info(
+            "Wrote {} rows of '{}' to {} sinks".format(len(frame), table, len(sinks))
+        )
+
+
+def missing(sinks: list[Sink], tables: list[str]) -> list[Sink]:
+    """Return the sinks that don't have some of the tables yet."""
+    return [sink for sink in sinks if not all(map(sink.exists, tables))]
+
+
+def last(sinks: list[Sink], table: str, column: str, where: dict = None):
+    """
+    Return the largest value of a column that every sink has, None if some
+    sinks don't have the table's rows yet.
+    """
+    values = [sink.last(table, column, where) for sink in sinks]
+    if not values or None in values:
+        return None
+    return min(values)
+
+
+def sheet_table(sheet: str) -> str:
+    """Return the table name of one of the YNAB sheets."""
+    if sheet.startswith("YNAB/Transactions"):
+        currency = sheet[len("YNAB/Transactions") :].lower()
+        return "_".join(filter(None, ["transactions", currency]))
+    return sheet[len("YNAB/") :].lower()
+
+
+def write_sheet(sinks: list[Sink], sheet: str, rows: list[list]):
+    """Write the rows built for one of the YNAB sheets as a table."""
+    if not sinks:
+        return
+    if sheet == "YNAB/Categories":
+        frame = categories_frame(rows)
+    elif sheet == "YNAB/Budgets":
+        frame = budgets_frame(rows)
+    else:
+        frame = transactions_frame(rows)
+    write_table(sinks, sheet_table(sheet), frame)
+
+
+def categories_frame(categories: list[list]):
+    """Category rows as built for the sheet, one subcategory per row."""
+    import pandas as pd
+
+    frame = pd.DataFrame(
+        {
+            "masterCategoryId": categories[0],
+            "masterCategoryName": categories[1],
+            "categoryId": categories[2],
+            "categoryName": categories[3],
+        }
+    )
+    # Master category names are only set on their first subcategory
+    frame["masterCategoryName"] = (
+        frame["masterCategoryName"].replace("", None).ffill().fillna("")
+    )
+    return frame
+
+
+def budgets_frame(budgets: list[list]):
+    """Budget matrix as built for the sheet, one month and category per row."""
+    import pandas as pd
+
+    months = budgets[1][2:]
+    records = []
+    for row in budgets[2:]:
+        values = row[2:] + [0] * (len(months) - len(row[2:]))
+        records.extend(zip(months, [row[0]] * len(months), values))
+    return pd.DataFrame(records, columns=["month", "categoryId", "budgeted"])
+
+
+def transactions_frame(transactions: list[list]):
+    """Rows under a header as built for the sheet, without formula columns."""
+    import pandas as pd
+
+    header = transactions[0]
+    columns = [i for i, name in enumerate(header) if not str(name).startswith("=")]
+    return pd.DataFrame(
+        [[row[i] for i in columns] for row in transactions[1:]],
+        columns=[header[i] for i in columns],
+    )
+
+
+def prices_frame(closes):
+    """Closes as a date x ticker DataFrame, one date and ticker per row."""
+    import pandas as pd
+
+    closes = closes.copy()
+    closes.index = pd.to_datetime(closes.index).strftime("%Y-%m-%d")
+    return (
+        closes.rename_axis(index="date", columns="ticker")
+        .stack()
+        .dropna()
+        .rename("close")
+        .reset_index()
+    )
+
+
+def rates_frame(currency: str, rates: list[tuple[str, float]]):
+    import pandas as pd
+
+    frame = pd.DataFrame(rates, columns=["date", "rate"])
+    frame.insert(1, "currency", currency)
+    return frame
+
+
+def inflation_frame(rows: list[list]):
+    """Yearly inflation rows as written to the KSH sheet, with decimal commas."""
+    import pandas as pd
+
+    frame = pd.DataFrame([row[:2] for row in rows], columns=["year", "rate"])
+    frame["year"] = frame["year"].astype(int)
+    frame["rate"] = pd.to_numeric(
+        frame["rate"].str.replace(",", "."), errors="coerce"
+    )
+    return frame
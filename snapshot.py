@@ -0,0 +1,63 @@
+import gzip
+import logging
+import os
+import pickle
+
+SNAPSHOT_VERSION = 1
+
+
+def load_snapshot(filename: str) -> dict:
+    """
+    Load the snapshot of the last synced tables.
+
+    The snapshot maps sheet names to the rows written there and the fingerprint
+    they were built from. A missing or unreadable
+    snapshot is treated as empty, it only speeds things up.
+    """
+    try:
+        with gzip.open(filename, "rb") as fp:
+            snapshot = pickle.load(fp)
+    except FileNotFoundError:
+        logging.info("No snapshot found at '{}'".format(filename))
+        return {"version": SNAPSHOT_VERSION, "tables": {}}
+    except (OSError, EOFError, pickle.UnpicklingError) as e:
+        logging.warning("Failed to load snapshot '{}': {}".format(filename, e))
+        return {"version": SNAPSHOT_VERSION, "tables": {}}
+
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        logging.info("Snapshot version mismatch, ignoring it")
+        return {"version": SNAPSHOT_VERSION, "tables": {}}
+
+    logging.info(
+        "Loaded snapshot of {} tables from '{}'".format(
+            len(snapshot["tables"]), filename
+        )
+    )
+    return snapshot
+
+
+def save_snapshot(filename: str, snapshot: dict):
+    """Save the snapshot if any tables were set since it was loaded."""
+    if not snapshot.pop("dirty", False):
+        logging.info("Snapshot is unchanged, not saving it")
+        return
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    tmp_filename = "{}.tmp".format(filename)
+    # Low compression level, loading speed matters more than size
+    with gzip.open(tmp_filename, "wb", compresslevel=1) as fp:
+        pickle.dump(snapshot, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_filename, filename)
+    logging.info("Saved snapshot of {} tables".format(len(snapshot["tables"])))
+
+
+def get_rows(snapshot: dict, sheet: str, fingerprint: str):
+    """Return the rows stored for a sheet, if they match what's in the sheet."""
+    table = snapshot["tables"].get(sheet)
+    if table is None or table["fingerprint"] != fingerprint:
+        return None
+    return table["rows"]
+
+
+def set_rows(snapshot: dict, sheet: str, fingerprint: str, rows):
+    snapshot["tables"][sheet] = {"fingerprint": fingerprint, "rows": rows}
+    snapshot["dirty"] = True
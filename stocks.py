@@ -1,23 +1,33 @@
 import gspread
+import json
 import logging
-import pandas as pd
+import os
+import queue
 import re
-import yfinance as yf
+import threading
+import time
 
 from datetime import date, datetime, timedelta
 
 
 class Stocks(object):
-    def __init__(self):
+    def __init__(self, quote_cache_filename=None):
         self.portfolio = {}
+        self.position_changes = []
+        self.currencies = {}
         self.prices = {}
         self.targets = {}
         self.budget = 0
         self.tolerance = 0.01
         self.penalty_scaling_factor = 1000
         self.spreadsheet = None
+        self.quote_cache_filename = quote_cache_filename
+        self.quote_timeout = 20
+        self.quote_workers = 4
+        # ISO date of the last prices in the sheet, set by get_historical_rates
+        self.last_date = None
 
-    def add_to_portfolio(self, data: dict):
+    def add_to_portfolio(self, data: dict, currency: str = None):
         portfolio = {}
         filter = re.compile(r"^-?\d+ [A-Z]+.[A-Z]+$")
         for txn in data["transactions"]:
@@ -34,12 +44,173 @@ class Stocks(object):
                 portfolio[parts[1]] = int(parts[0])
             else:
                 portfolio[parts[1]] += int(parts[0])
+            self.position_changes.append(
+                {"date": txn["date"], "ticker": parts[1], "shares": int(parts[0])}
+            )
+            if currency is not None:
+                self.currencies[parts[1]] = currency
         self.portfolio |= portfolio
 
+    def update_valuation(
+        self, yfinance_worksheet, mnb_worksheet, worksheet, archive_worksheet=None
+    ):
+        """
+        Store daily holdings and their HUF value for every ticker.
+
+        Position changes from the transactions are accumulated per day and
+        multiplied with the closing prices from the yfinance sheet (and its
+        archive if history is compacted) and the exchange rate of the budget
+        currency the ticker was bought in from the MNB sheet. Prices and rates
+        are carried forward over days without data.
+        """
+        import numpy as np
+        import pandas as pd
+
+        if not self.position_changes:
+            logging.info("No positions to value")
+            return
+
+        logging.info("Calculating portfolio valuation")
+        prices = self.read_prices(yfinance_worksheet, archive_worksheet)
+        rates = self.read_rates(mnb_worksheet)
+        rates["HUF"] = 1.0
+
+        changes = pd.DataFrame(self.position_changes)
+        changes["date"] = pd.to_datetime(changes["date"])
+        deltas = changes.pivot_table(
+            index="date", columns="ticker", values="shares", aggfunc="sum"
+        )
+        tickers = list(deltas.columns)
+        days = pd.date_range(
+            deltas.index.min(),
+            max([deltas.index.max()] + list(prices.index[-1:]) + list(rates.index[-1:])),
+            freq="D",
+        )
+
+        holdings = deltas.reindex(days).fillna(0).cumsum()
+        # Reindex against the union first so values carry forward into gaps
+        close = (
+            prices.reindex(columns=tickers)
+            .reindex(prices.index.union(days))
+            .ffill()
+            .reindex(days)
+        )
+        fx = (
+            rates.reindex(
+                columns=[self.currencies.get(ticker, "HUF") for ticker in tickers]
+            )
+            .reindex(rates.index.union(days))
+            .ffill()
+            .reindex(days)
+        )
+        values = holdings.to_numpy() * close.to_numpy() * fx.to_numpy()
+        total = np.nansum(values, axis=1)
+
+        block = np.column_stack([total, holdings.to_numpy(), np.round(values, 2)])
+        cells = np.where(np.isnan(block), "", block.astype(object))
+        header = (
+            ["date", "totalHuf"]
+            + ["{} shares".format(ticker) for ticker in tickers]
+            + ["{} huf".format(ticker) for ticker in tickers]
+        )
+        dates = days.strftime("%Y-%m-%d").to_numpy().reshape(-1, 1)
+        rows = [header] + np.hstack([dates, cells]).tolist()
+
+        logging.info(
+            "Storing valuation of {} tickers over {} days".format(
+                len(tickers), len(days)
+            )
+        )
+        worksheet.clear()
+        worksheet.resize(len(rows), len(header))
+        worksheet.update(rows, raw=False)
+        worksheet.freeze(1, 1)
+
+    def read_prices(self, yfinance_worksheet, archive_worksheet=None):
+        """
+        Read the closes of the yfinance sheet, and its archive if history is
+        compacted, as a date x ticker DataFrame.
+        """
+        import pandas as pd
+
+        prices = self._read_sheet_series(yfinance_worksheet, 1, 4)
+        if archive_worksheet is not None:
+            prices = pd.concat(
+                [self._read_sheet_series(archive_worksheet, 1, 2), prices]
+            )
+            prices = prices[~prices.index.duplicated(keep="last")].sort_index()
+        return prices
+
+    def read_rates(self, mnb_worksheet):
+        """Read the MNB sheet's rates as a date x currency DataFrame."""
+        return self._read_sheet_series(mnb_worksheet, 1, 2)
+
+    def fetch_closes(self, start: str):
+        """
+        Fetch the closes of every ticker in the portfolio from start until the
+        last market day as a date x ticker DataFrame, None if there are none.
+        """
+        import yfinance as yf
+
+        tickers = sorted(self.portfolio)
+        if not tickers:
+            return None
+        logging.info("Fetching {} tickers from {}".format(len(tickers), start))
+        data = yf.download(
+            tickers,
+            start=start,
+            end=datetime.today().strftime("%Y-%m-%d"),
+            progress=False,
+        )
+        if data.empty:
+            return None
+        return self._closes(data, tickers)
+
+    def _closes(self, data, tickers):
+        """Close prices of a yf.download frame as a date x ticker frame."""
+        import pandas as pd
+
+        if isinstance(data.columns, pd.MultiIndex):
+            closes = data.xs("Close", axis=1, level=0)
+        else:
+            closes = data[["Close"]].set_axis(tickers[:1], axis=1)
+        return closes.astype(float).dropna(how="all")
+
+    def _read_sheet_series(self, worksheet, header_row, first_row):
+        """
+        Read a sheet with dates in column A and a series per column as a
+        DataFrame, using the names in the header row as columns.
+        """
+        import pandas as pd
+
+        header, values = worksheet.batch_get(
+            [
+                "{}:{}".format(header_row, header_row),
+                "{}:{}".format(first_row, worksheet.row_count),
+            ],
+            value_render_option=gspread.utils.ValueRenderOption.unformatted,
+        )
+        names = header[0][1:] if header else []
+        width = len(names) + 1
+        rows = [
+            row[:width] + [None] * (width - len(row))
+            for row in values
+            if row and isinstance(row[0], (int, float))
+        ]
+        frame = pd.DataFrame(rows, columns=["date"] + names)
+        # Dates are rendered as serial numbers counted from 1899-12-30
+        frame["date"] = pd.to_datetime(frame["date"], unit="D", origin="1899-12-30")
+        frame = frame.set_index("date").sort_index()
+        frame = frame[~frame.index.duplicated(keep="last")]
+        frame = frame.loc[:, [name != "" for name in frame.columns]]
+        return frame.apply(pd.to_numeric, errors="coerce")
+
     def get_historical_rates(self, worksheet):
         """
         Fetch and store historical stock prices in a Google Sheet.
 
+        Returns the fetched closes as a date x ticker DataFrame, or None.
+
         Sheet structure:
         - Column A: Dates (A3 = formula for last date, A4+ = historical dates)
         - Row 1: Ticker symbols (yfinance format)
@@ -53,28 +224,32 @@ class Stocks(object):
 
         if not new_tickers and not existing_tickers:
             logging.info("No tickers to process")
-            return
+            # Nothing to wait for
+            self.last_date = None
+            return None
+        self.last_date = max(sheet_dates) if sheet_dates else None
 
         # Step 3: Batch fetch data from yfinance
-        all_ticker_data = self._fetch_ticker_data(
+        closes = self._fetch_ticker_data(
             worksheet, new_tickers, existing_tickers, sheet_dates, sheet_tickers
         )
 
-        if not all_ticker_data:
+        if closes is None or closes.empty:
             logging.warning("No data fetched from yfinance")
-            return
+            return None
 
         # Step 4: Reconcile dates and insert rows if needed
         final_dates, date_to_row = self._reconcile_dates(
-            worksheet, sheet_dates, all_ticker_data, date_to_row
+            worksheet, sheet_dates, closes, date_to_row
         )
+        self.last_date = max(final_dates)
 
         # Step 5: Prepare batch updates
         updates = self._prepare_batch_updates(
             worksheet,
             new_tickers,
             existing_tickers,
-            all_ticker_data,
+            closes,
             sheet_tickers,
             date_to_row,
         )
@@ -88,6 +263,86 @@ class Stocks(object):
             logging.info("Stock price data updated successfully")
         else:
             logging.info("No updates to apply")
+        return closes
+
+    def compact_history(
+        self, worksheet, archive_worksheet, window_days, frequency="monthly"
+    ):
+        """
+        Move daily prices older than the window to the archive as period closes.
+
+        Only whole weeks or months are archived, each as a single row with the
+        last close of every ticker in the period. The archived rows are deleted
+        from the live sheet, which keeps its layout (tickers in row 1, dates from
+        row 4), so the date to row mapping stays consistent and the live sheet
+        only holds about window_days of rows. The archive has the same tickers
+        in row 1 and a row per period from row 2.
+        """
+        import pandas as pd
+
+        cutoff = date.today() - timedelta(days=window_days)
+        if frequency == "weekly":
+            cutoff -= timedelta(days=cutoff.weekday())
+            period = "W"
+        else:
+            cutoff = cutoff.replace(day=1)
+            period = "M"
+        cutoff = cutoff.strftime("%Y-%m-%d")
+
+        # Dates are sorted, rows to archive are the ones before the cutoff
+        sheet_dates, sheet_tickers, date_to_row = self._parse_sheet_structure(worksheet)
+        old_dates = [d for d in sheet_dates if d < cutoff]
+        if not old_dates:
+            logging.info("No price history before {} to compact".format(cutoff))
+            return
+        last_row = date_to_row[old_dates[-1]]
+
+        logging.info(
+            "Compacting {} daily price rows before {} into {} closes".format(
+                len(old_dates), cutoff, frequency
+            )
+        )
+        last_cell = gspread.utils.rowcol_to_a1(last_row, worksheet.col_count)
+        header, values = worksheet.batch_get(
+            ["1:1", "A4:{}".format(last_cell)],
+            value_render_option=gspread.utils.ValueRenderOption.unformatted,
+        )
+        names = header[0][1:] if header else []
+        width = len(names) + 1
+        rows = [row[:width] + [None] * (width - len(row)) for row in values]
+        frame = pd.DataFrame(rows, columns=["date"] + names)
+        frame["date"] = pd.to_datetime(
+            frame["date"], unit="D", origin="1899-12-30", errors="coerce"
+        )
+        frame = frame.dropna(subset=["date"]).set_index("date")
+        frame = frame.apply(pd.to_numeric, errors="coerce")
+
+        # Last close per period, labelled with the last trading day of it
+        periods = frame.index.to_period(period)
+        closes = frame.groupby(periods).last()
+        closes.index = frame.index.to_series().groupby(periods).max().to_numpy()
+
+        archive = [
+            [day.strftime("%Y-%m-%d")]
+            + ["" if pd.isna(price) else price for price in row]
+            for day, row in zip(closes.index, closes.itertuples(index=False))
+        ]
+        if archive_worksheet.col_count < width:
+            archive_worksheet.add_cols(width - archive_worksheet.col_count)
+        archive_worksheet.update("A1", [["Date"] + names])
+        archive_worksheet.append_rows(
+            archive,
+            value_input_option=gspread.utils.ValueInputOption.user_entered,
+            table_range="A1",
+        )
+
+        # Archive first, a failure in between duplicates rows instead of losing them
+        worksheet.delete_rows(4, last_row)
+        logging.info(
+            "Archived {} {} closes, removed rows 4-{}".format(
+                len(archive), frequency, last_row
+            )
+        )
 
     def _parse_sheet_structure(self, worksheet):
         """Parse existing dates and tickers from the sheet."""
@@ -164,10 +419,160 @@ class Stocks(object):
 
         return tickers_missing_data
 
+    def _fetch_fallback_quotes(self, tickers):
+        """
+        Fetch the last quote of tickers without price history concurrently.
+
+        At most quote_workers requests are in flight, a request running longer
+        than quote_timeout seconds is abandoned and its worker replaced. Quotes
+        are cached per ticker and market date, so reruns on the same day don't
+        fetch them again.
+        """
+        market_date = self._market_date().isoformat()
+        cache = self._load_quote_cache(market_date)
+        quotes = {}
+        to_fetch = []
+        for ticker in tickers:
+            key = "{}|{}".format(ticker, market_date)
+            if key in cache:
+                logging.info("Using cached last day data for {}".format(ticker))
+                quotes[ticker] = cache[key]
+            else:
+                to_fetch.append(ticker)
+
+        if not to_fetch:
+            return quotes
+
+        tasks = queue.Queue()
+        results = queue.Queue()
+        started = {}
+        for ticker in to_fetch:
+            tasks.put(ticker)
+
+        def worker():
+            while True:
+                try:
+                    ticker = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                started[ticker] = time.monotonic()
+                try:
+                    results.put((ticker, self._fetch_quote(ticker), None))
+                except Exception as e:
+                    results.put((ticker, None, e))
+
+        def start_worker():
+            # Daemon threads, so a hanging request can't block the exit
+            threading.Thread(target=worker, daemon=True).start()
+
+        logging.info("Fetching last day data for {}".format(to_fetch))
+        for _ in range(min(self.quote_workers, len(to_fetch))):
+            start_worker()
+
+        remaining = set(to_fetch)
+        while remaining:
+            try:
+                ticker, quote, error = results.get(timeout=0.5)
+            except queue.Empty:
+                ticker = None
+
+            if ticker in remaining:
+                remaining.discard(ticker)
+                if error is not None:
+                    logging.error(
+                        "Error fetching 1-day data for {}: {}".format(ticker, error)
+                    )
+                else:
+                    logging.info("Successfully fetched 1-day data for {}".format(ticker))
+                    quotes[ticker] = quote
+                    cache["{}|{}".format(ticker, market_date)] = quote
+
+            now = time.monotonic()
+            for ticker in list(remaining):
+                if ticker in started and now - started[ticker] > self.quote_timeout:
+                    logging.error("Timed out fetching 1-day data for {}".format(ticker))
+                    remaining.discard(ticker)
+                    start_worker()
+
+        self._save_quote_cache(cache)
+        return quotes
+
+    def _fetch_quote(self, ticker):
+        import yfinance as yf
+
+        info = yf.Ticker(ticker).info
+        return {
+            "date": date.fromtimestamp(info["regularMarketTime"]).isoformat(),
+            "close": info["regularMarketPrice"],
+            "high": info["dayHigh"],
+            "low": info["dayLow"],
+            "open": info["open"],
+            "volume": info["volume"],
+        }
+
+    def _market_date(self):
+        """Last weekday, the date quotes are cached for."""
+        today = date.today()
+        return today - timedelta(days=max(0, today.weekday() - 4))
+
+    def _load_quote_cache(self, market_date):
+        if self.quote_cache_filename is None:
+            return {}
+        try:
+            with open(self.quote_cache_filename, "r") as fp:
+                cache = json.load(fp)
+        except (OSError, ValueError):
+            return {}
+        # Quotes of earlier market dates are not needed anymore
+        return {
+            key: quote
+            for key, quote in cache.items()
+            if key.endswith("|{}".format(market_date))
+        }
+
+    def _save_quote_cache(self, cache):
+        if self.quote_cache_filename is None:
+            return
+        os.makedirs(os.path.dirname(self.quote_cache_filename) or ".", exist_ok=True)
+        tmp_filename = "{}.tmp".format(self.quote_cache_filename)
+        with open(tmp_filename, "w") as fp:
+            json.dump(cache, fp)
+        os.replace(tmp_filename, self.quote_cache_filename)
+
+    def _last_populated_rows(self, worksheet, sheet_tickers):
+        """Last row with a value per ticker, read with a single request."""
+        import numpy as np
+
+        if not sheet_tickers or worksheet.row_count < 4:
+            return {}
+        last_cell = gspread.utils.rowcol_to_a1(
+            worksheet.row_count, max(sheet_tickers.values())
+        )
+        values = worksheet.get("A4:{}".format(last_cell))
+        width = max(sheet_tickers.values())
+        populated = np.zeros((len(values), width), dtype=bool)
+        for i, row in enumerate(values):
+            populated[i, : len(row)] = [cell != "" for cell in row]
+
+        last_rows = {}
+        for ticker, col in sheet_tickers.items():
+            rows = np.flatnonzero(populated[:, col - 1])
+            if len(rows):
+                last_rows[ticker] = int(rows[-1]) + 4
+        return last_rows
+
     def _fetch_ticker_data(
         self, worksheet, new_tickers, existing_tickers, sheet_dates, sheet_tickers
     ):
-        """Fetch historical data for all tickers."""
+        """
+        Fetch historical closing prices for all tickers.
+
+        Returns a DataFrame indexed by date with a column per ticker, NaN where
+        there is no price, or None if there is nothing to fetch.
+        """
+        import pandas as pd
+        import yfinance as yf
+
         logging.info("Fetching data from yfinance")
 
         # Determine date ranges for fetching
@@ -187,36 +592,26 @@ class Stocks(object):
                 fetch_params[ticker] = start_date
 
         # For existing tickers: find last populated cell and fetch from next day
+        try:
+            last_rows = self._last_populated_rows(worksheet, sheet_tickers)
+        except Exception as e:
+            logging.warning("Error finding last dates: {}".format(e))
+            last_rows = {}
         for ticker in existing_tickers:
-            col = sheet_tickers[ticker]
-            try:
-                last_cells = worksheet.findall(re.compile(r"^.+$"), in_column=col)
-                if last_cells:
-                    last_row = last_cells[-1].row
-                    last_date_str = (
-                        sheet_dates[last_row - 4]
-                        if last_row - 4 < len(sheet_dates)
-                        else None
-                    )
-
-                    if last_date_str:
-                        last_date = datetime.strptime(last_date_str, "%Y-%m-%d")
-                        fetch_params[ticker] = (last_date + timedelta(days=1)).strftime(
-                            "%Y-%m-%d"
-                        )
-                    else:
-                        fetch_params[ticker] = sheet_dates[0] if sheet_dates else None
-                else:
-                    fetch_params[ticker] = sheet_dates[0] if sheet_dates else None
-            except Exception as e:
-                logging.warning("Error finding last date for {}: {}".format(ticker, e))
+            last_row = last_rows.get(ticker)
+            if last_row is not None and last_row - 4 < len(sheet_dates):
+                last_date = datetime.strptime(sheet_dates[last_row - 4], "%Y-%m-%d")
+                fetch_params[ticker] = (last_date + timedelta(days=1)).strftime(
+                    "%Y-%m-%d"
+                )
+            else:
                 fetch_params[ticker] = sheet_dates[0] if sheet_dates else None
 
         # Find earliest start date to fetch all at once
         valid_dates = [d for d in fetch_params.values() if d]
         if not valid_dates:
             logging.warning("No valid start dates found")
-            return {}
+            return None
 
         earliest_start = min(valid_dates)
 
@@ -228,7 +623,7 @@ class Stocks(object):
                     earliest_start
                 )
             )
-            return {}
+            return None
 
         # Batch fetch all tickers
         logging.info(
@@ -245,7 +640,7 @@ class Stocks(object):
 
             if data.empty:
                 logging.warning("No data returned from yfinance")
-                return {}
+                return None
 
             # Detect tickers with all NaN Close values
             tickers_missing_data = self._detect_missing_ticker_data(data, all_tickers)
@@ -257,81 +652,56 @@ class Stocks(object):
                     )
                 )
 
-                # Retry fetching with period="1d" for each NaN ticker
-                for ticker in tickers_missing_data:
-                    try:
-                        logging.info("Fetching last day data for {}".format(ticker))
-                        info = yf.Ticker(ticker).info
-
-                        prevDate = date.fromtimestamp(info['regularMarketTime'])
-                        prevDateIndex = datetime(prevDate.year, prevDate.month, prevDate.day)
-
-                        values = [info['regularMarketPrice'], info['dayHigh'], info['dayLow'], info['open'], info['volume']]
-                        index = pd.DatetimeIndex([prevDateIndex], name='Date')
-                        cols = pd.MultiIndex.from_product([
-                            ['Close', 'High', 'Low', 'Open', 'Volume'], [ticker]
-                        ], names=['Price', 'Ticker'])
-
-                        day_data = pd.DataFrame([values], columns=cols, index=index)
-
-                        if not day_data.empty:
-                            # Merge the 1-day data into the main dataframe
-                            data.update(day_data)
-                            logging.info(
-                                "Successfully fetched 1-day data for {}".format(ticker)
-                            )
-                        else:
-                            logging.warning(
-                                "No 1-day data available for {}".format(ticker)
-                            )
-                    except Exception as e:
-                        logging.error(
-                            "Error fetching 1-day data for {}: {}".format(ticker, e)
-                        )
-
-            # Extract Close prices and convert to dict
-            close_data = data.filter(like="Close", axis=1).to_dict(orient="dict")
-            result = {}
-
-            for key, prices in close_data.items():
-                # key is either 'Close' (single ticker) or ('Close', 'TICKER') (multiple tickers)
-                if isinstance(key, tuple):
-                    ticker = key[1]
-                else:
-                    ticker = all_tickers[0]
-
-                # Convert Timestamp keys to YYYY-MM-DD strings, filter out NaN values
-                result[ticker] = {
-                    timestamp.strftime("%Y-%m-%d"): price
-                    for timestamp, price in prices.items()
-                    if not (isinstance(price, float) and price != price)  # Skip NaN
-                }
+                quotes = self._fetch_fallback_quotes(tickers_missing_data)
+                for ticker, quote in quotes.items():
+                    index = pd.DatetimeIndex(
+                        [datetime.strptime(quote["date"], "%Y-%m-%d")], name="Date"
+                    )
+                    cols = pd.MultiIndex.from_product(
+                        [["Close", "High", "Low", "Open", "Volume"], [ticker]],
+                        names=["Price", "Ticker"],
+                    )
+                    values = [
+                        quote["close"],
+                        quote["high"],
+                        quote["low"],
+                        quote["open"],
+                        quote["volume"],
+                    ]
+                    # Merge the 1-day data into the main dataframe
+                    data.update(pd.DataFrame([values], columns=cols, index=index))
+
+            closes = self._closes(data, all_tickers)
 
-            logging.info("Successfully fetched data for {} tickers".format(len(result)))
-            return result
+            logging.info(
+                "Successfully fetched data for {} tickers".format(len(closes.columns))
+            )
+            return closes
 
         except Exception as e:
+            # Raised, so the step is retried by the next run
             logging.error("Error fetching data from yfinance: {}".format(e))
-            return {}
+            raise
 
-    def _reconcile_dates(self, worksheet, sheet_dates, all_ticker_data, date_to_row):
-        """Reconcile dates from yfinance with sheet dates, insert rows as needed."""
-        logging.info("Reconciling dates")
+    def _reconcile_dates(self, worksheet, sheet_dates, closes, date_to_row):
+        """
+        Reconcile dates from yfinance with sheet dates.
 
-        # Collect all unique dates from fetched data
-        fetched_dates = set()
-        for ticker_data in all_ticker_data.values():
-            fetched_dates.update(ticker_data.keys())
+        Returns the sorted union of dates and the row of every date, rows after
+        a new date are shifted down by one for each new date before them.
+        """
+        import numpy as np
 
-        # Merge and sort all dates
-        all_dates = sorted(set(sheet_dates) | fetched_dates)
+        logging.info("Reconciling dates")
 
-        # Find new dates that need row insertion
-        new_dates = sorted(fetched_dates - set(sheet_dates))
+        fetched_dates = closes.index.strftime("%Y-%m-%d")
+        existing = np.array(sheet_dates, dtype=object)
+        new_dates = np.setdiff1d(fetched_dates.to_numpy(dtype=object), existing)
+        all_dates = np.union1d(existing, new_dates)
 
-        if not new_dates:
+        if not len(new_dates):
             logging.info("No new dates to insert")
-            return all_dates, date_to_row
+            return list(all_dates), date_to_row
 
         logging.info("Inserting {} new date rows".format(len(new_dates)))
 
@@ -342,31 +712,39 @@ class Stocks(object):
             logging.info("Adding {} rows to worksheet".format(rows_to_add))
             worksheet.add_rows(rows_to_add)
 
-        # Insert rows for new dates at correct positions
-        for date in new_dates:
-            # Find insertion position
-            insert_pos = all_dates.index(date) + 4  # +4 for header rows
-
-            # Update date_to_row mapping for dates after insertion
-            for existing_date, row in list(date_to_row.items()):
-                if row >= insert_pos:
-                    date_to_row[existing_date] = row + 1
-
-            # Add new date to mapping
-            date_to_row[date] = insert_pos
+        # Existing dates move down by the number of new dates sorted before them
+        shifted = dict(
+            zip(
+                date_to_row.keys(),
+                (
+                    np.fromiter(date_to_row.values(), dtype=int, count=len(date_to_row))
+                    + np.searchsorted(new_dates, list(date_to_row.keys()))
+                ).tolist(),
+            )
+        )
+        new_rows = np.searchsorted(all_dates, new_dates) + 4  # +4 for header rows
+        shifted.update(zip(new_dates.tolist(), new_rows.tolist()))
 
-        return all_dates, date_to_row
+        return list(all_dates), shifted
 
     def _prepare_batch_updates(
         self,
         worksheet,
         new_tickers,
         existing_tickers,
-        all_ticker_data,
+        closes,
         sheet_tickers,
         date_to_row,
     ):
-        """Prepare batch update data for the sheet."""
+        """
+        Prepare batch update data for the sheet.
+
+        Dates and prices are written as a single block from column A to the
+        last ticker column, spanning the rows of the fetched dates. Cells
+        without a fetched price are null, which the API leaves untouched.
+        """
+        import numpy as np
+
         logging.info("Preparing batch updates")
 
         updates = []
@@ -398,33 +776,32 @@ class Stocks(object):
                 {"range": gspread.utils.rowcol_to_a1(1, new_col), "values": [[ticker]]}
             )
 
-        # Add date values and price data
-        for ticker, ticker_data in all_ticker_data.items():
-            if ticker not in sheet_tickers:
-                logging.warning(
-                    "Ticker {} not in sheet_tickers, skipping".format(ticker)
-                )
-                continue
-
-            col = sheet_tickers[ticker]
-
-            for date, price in ticker_data.items():
-                if date not in date_to_row:
-                    logging.warning(
-                        "Date {} not in date_to_row mapping, skipping".format(date)
-                    )
-                    continue
-
-                row = date_to_row[date]
-
-                # Add date to column A if needed
-                updates.append(
-                    {"range": gspread.utils.rowcol_to_a1(row, 1), "values": [[date]]}
-                )
-
-                # Add price data
-                updates.append(
-                    {"range": gspread.utils.rowcol_to_a1(row, col), "values": [[price]]}
-                )
-
+        unknown = [ticker for ticker in closes.columns if ticker not in sheet_tickers]
+        if unknown:
+            logging.warning("Tickers {} not in sheet_tickers, skipping".format(unknown))
+        closes = closes.drop(columns=unknown)
+        if closes.empty:
+            return updates
+
+        dates = closes.index.strftime("%Y-%m-%d")
+        rows = np.array([date_to_row[d] for d in dates])
+        cols = np.array([sheet_tickers[ticker] for ticker in closes.columns])
+        first_row, last_row = rows.min(), rows.max()
+
+        # Dates in column A, prices in their ticker columns, null everywhere else
+        block = np.full((last_row - first_row + 1, cols.max()), None, dtype=object)
+        block[rows - first_row, 0] = dates.to_numpy(dtype=object)
+        prices = closes.to_numpy(dtype=float)
+        cells = np.where(np.isnan(prices), None, prices.astype(object))
+        block[np.ix_(rows - first_row, cols - 1)] = cells
+
+        updates.append(
+            {
+                "range": "{}:{}".format(
+                    gspread.utils.rowcol_to_a1(first_row, 1),
+                    gspread.utils.rowcol_to_a1(last_row, cols.max()),
+                ),
+                "values": block.tolist(),
+            }
+        )
         return updates